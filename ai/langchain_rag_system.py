@@ -6,31 +6,339 @@ Uses LangChain tools to search channels incrementally
 
 import os
 import json
+import logging
 import re
-from typing import List, Dict, Any, Tuple, Optional
+import asyncio
+import atexit
+import hashlib
+import importlib.util
+import pickle
+import sqlite3
+import sys
+import threading
+import unicodedata
+from collections import defaultdict, OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import List, Dict, Any, Tuple, Optional, AsyncIterator, Awaitable, Iterator
+import numpy as np
 import openai
 from dotenv import load_dotenv
+
+# Optional approximate nearest-neighbour index for large channels
+try:
+    import faiss
+    faiss.omp_set_num_threads(os.cpu_count() or 1)
+except ImportError:
+    faiss = None
+
+# Faster JSON parsing for the message database when available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional Aho-Corasick automaton for matching all query patterns in one pass
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Optional fuzzy matcher for misspelled channel names
+try:
+    from rapidfuzz import process as fuzz_process, fuzz
+except ImportError:
+    fuzz_process = None
 from datetime import datetime
 import time
 
 # Load environment variables
 load_dotenv()
 
+# Per-query search diagnostics go to DEBUG so they cost nothing in production
+logger = logging.getLogger(__name__)
+
 # Configure OpenAI client
 openai.api_key = os.getenv('GEMINI_API_KEY')
 openai.base_url = os.getenv('GEMINI_BASE_URL', 'https://api.gapgpt.app/v1')
 
+# The keyword index maps character n-grams to messages, so any query word of at least
+# this many characters can be looked up as a substring (keyword rules match substrings)
+_NGRAM = 3
+
+# Bumped whenever the way texts are folded or indexed changes, to invalidate saved postings
+_KEYWORD_INDEX_VERSION = 3
+
+# Text preprocessing patterns, compiled once at import
+_URL_RE = re.compile(r'http[s]?://[^\s]+')
+_NON_TEXT_RE = re.compile(r'[^\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFFa-zA-Z0-9\s]')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Message links the agent cites in its answers
+_MESSAGE_LINK_RE = re.compile(r'https?://t\.me/([A-Za-z0-9_]+)/\d+')
+_STOP_WORDS = frozenset([
+    'و', 'در', 'به', 'از', 'که', 'این', 'آن', 'با', 'برای', 'تا', 'را', 'یا', 'اما', 'اگر', 'چون',
+    'چرا', 'چگونه', 'کجا', 'کی', 'چه', 'چند', 'هم', 'نیز', 'همچنین', 'همه', 'هیچ', 'هر'
+])
+
+# Zero-width characters (ZWSP/ZWNJ/ZWJ/word joiner/BOM) that make equal queries look different
+_ZERO_WIDTH_RE = re.compile('[\u200b-\u200f\u2060\ufeff]')
+
+# Common names and misspellings the agent uses for channels
+_CHANNEL_ALIASES = {
+    'یاریگران': 'yarigaran_sharif',
+    'yaregaran': 'yarigaran_sharif',  # Common misspelling
+    'yareegaran': 'yarigaran_sharif',  # Another common misspelling
+    'yari': 'yarigaran_sharif',
+    'شریف': 'sharif_senfi',
+    'شورای صنفی': 'sharif_senfi',
+    'روزنامه': 'sharifdaily',
+    'daily': 'sharifdaily'
+}
+
+# Number of final answers kept in memory
+ANSWER_CACHE_SIZE = 512
+
+# Per-channel search results kept in memory (an answer usually takes several searches),
+# and how long a stored result is reused
+TOOL_CACHE_SIZE = 4 * ANSWER_CACHE_SIZE
+TOOL_CACHE_TTL = float(os.getenv('TOOL_CACHE_TTL', str(24 * 3600)))
+
+# Channels whose database shard, lowered texts and keyword postings are kept in memory at once
+MAX_LOADED_CHANNELS = 32
+
+# Paraphrased questions closer than this (cosine) reuse a cached answer for up to SEMANTIC_CACHE_TTL seconds
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.85'))
+SEMANTIC_CACHE_TTL = float(os.getenv('SEMANTIC_CACHE_TTL', str(24 * 3600)))
+
+# Number of query embeddings kept in memory (the agent re-sends the same query to several tools)
+QUERY_EMBEDDING_CACHE_SIZE = 128
+
+# Channels with at least this many embedded messages get a FAISS HNSW index,
+# and very large ones a compressed IVF-PQ index; smaller ones use a plain matmul
+ANN_MIN_MESSAGES = int(os.getenv('ANN_MIN_MESSAGES', '20000'))
+IVFPQ_MIN_MESSAGES = int(os.getenv('IVFPQ_MIN_MESSAGES', '200000'))
+
+# GPU memory (MB) for channel embedding copies; least recently searched channels are evicted
+# past it, and a channel larger than the whole budget is searched on the CPU
+GPU_INDEX_BUDGET_MB = int(os.getenv('GPU_INDEX_BUDGET_MB', '1024'))
+
+# Storage type of message embedding matrices: fp32, fp16 (half the size) or int8 (a quarter,
+# searched through a FAISS 8-bit scalar-quantizer index when faiss is installed)
+EMBED_DTYPE = os.getenv('EMBED_DTYPE', 'fp32').lower()
+if EMBED_DTYPE not in ('fp32', 'fp16', 'int8'):
+    print(f"⚠️ Unknown EMBED_DTYPE '{EMBED_DTYPE}', using fp32")
+    EMBED_DTYPE = 'fp32'
+
+
+class _StreamReset(str):
+    """Type of STREAM_RESET"""
+
+
+# Yielded by aquery when the text it streamed so far was the preamble of a tool-calling turn;
+# consumers drop what they collected. It is an empty string, so plain concatenation still works
+STREAM_RESET = _StreamReset()
+
+# Errors aquery answers with an apology (and a REPL turn survives); anything else is a bug and propagates
+_RETRYABLE = (TimeoutError, ConnectionError, ValueError, openai.OpenAIError)
+try:
+    from langchain_core.exceptions import LangChainException
+    _RETRYABLE += (LangChainException,)
+except ImportError:
+    pass
+
+
+def normalize_query(text: str) -> str:
+    """Canonical form of a query used as a cache key"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = _ZERO_WIDTH_RE.sub('', text)
+    return _WHITESPACE_RE.sub(' ', text).strip()
+
+
+def _ngrams(text: str) -> set:
+    """Distinct character n-grams of a text"""
+    return {text[j:j + _NGRAM] for j in range(len(text) - _NGRAM + 1)}
+
+
+def _build_ngram_postings(texts: List[str]) -> Dict[str, np.ndarray]:
+    """Map every character n-gram to the positions of the texts containing it"""
+    postings = defaultdict(list)
+    for i, text in enumerate(texts):
+        if text:
+            for gram in _ngrams(text):
+                postings[gram].append(i)
+    return {gram: np.array(positions, dtype=np.int32) for gram, positions in postings.items()}
+
+
+def _substring_candidates(postings: Dict[str, np.ndarray], word: str) -> np.ndarray:
+    """Positions of texts holding every n-gram of word, a superset of the texts containing word"""
+    lists = []
+    for gram in _ngrams(word):
+        positions = postings.get(gram)
+        if positions is None:
+            return np.zeros(0, dtype=np.int32)
+        lists.append(positions)
+    
+    # Rarest first keeps the intersections small
+    lists.sort(key=len)
+    result = lists[0]
+    for positions in lists[1:]:
+        if not len(result):
+            break
+        result = np.intersect1d(result, positions, assume_unique=True)
+    return result
+
+
+def _json_loads(data: bytes) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _json_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj) if orjson is not None else json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+class LazyChannels(Mapping):
+    """Read-only channels mapping that loads each channel's shard from disk on first access"""
+    
+    def __init__(self, shard_dir: str, usernames: List[str], max_loaded: int = MAX_LOADED_CHANNELS):
+        self.shard_dir = shard_dir
+        self._usernames = list(usernames)
+        self._known = set(self._usernames)
+        self._load = lru_cache(maxsize=max_loaded)(self._read_shard)
+    
+    def _read_shard(self, channel_username: str) -> Dict[str, Any]:
+        with open(os.path.join(self.shard_dir, f"{channel_username}.json"), 'rb') as f:
+            return _json_loads(f.read())
+    
+    def __getitem__(self, channel_username: str) -> Dict[str, Any]:
+        if channel_username not in self._known:
+            raise KeyError(channel_username)
+        return self._load(channel_username)
+    
+    def __contains__(self, channel_username) -> bool:
+        # Membership must not load the shard
+        return channel_username in self._known
+    
+    def __iter__(self):
+        return iter(self._usernames)
+    
+    def __len__(self) -> int:
+        return len(self._usernames)
+
+
+class SemanticCache:
+    """Answers to earlier questions, looked up by embedding similarity to catch paraphrases"""
+    
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, ttl: float = SEMANTIC_CACHE_TTL, max_entries: int = ANSWER_CACHE_SIZE):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.vecs = None  # (N, D) float32, rows L2-normalized
+        self.answers = []
+        self.created = np.zeros(0, dtype=np.float64)
+        self._lock = threading.Lock()
+    
+    def lookup(self, vec: np.ndarray) -> Optional[str]:
+        """Cached answer for the most similar fresh question, if it is similar enough"""
+        with self._lock:
+            if not self.answers:
+                return None
+            sims = self.vecs @ vec
+            # Expired entries can never win
+            sims[self.created < time.time() - self.ttl] = -1.0
+            idx = int(np.argmax(sims))
+            return self.answers[idx] if sims[idx] >= self.threshold else None
+    
+    def add(self, vec: np.ndarray, answer: str, created: Optional[float] = None):
+        """Remember an answer, evicting expired and then oldest entries beyond max_entries"""
+        vec = np.asarray(vec, dtype=np.float32)[None, :]
+        with self._lock:
+            if self.vecs is None:
+                self.vecs = vec
+            else:
+                self.vecs = np.vstack([self.vecs, vec])
+            self.answers.append(answer)
+            self.created = np.append(self.created, time.time() if created is None else created)
+            
+            keep = np.flatnonzero(self.created >= time.time() - self.ttl)[-self.max_entries:]
+            if len(keep) < len(self.answers):
+                self.vecs = self.vecs[keep]
+                self.answers = [self.answers[i] for i in keep]
+                self.created = self.created[keep]
+    
+    def evict_older_than(self, cutoff: float):
+        """Drop entries created before cutoff"""
+        with self._lock:
+            keep = np.flatnonzero(self.created >= cutoff)
+            if len(keep) < len(self.answers):
+                self.vecs = self.vecs[keep]
+                self.answers = [self.answers[i] for i in keep]
+                self.created = self.created[keep]
+
+
 class LangChainRAGSystem:
     def __init__(self, database_file: str = "test_channels_database.json", config_file: str = "multi_channel_config.json"):
         self.database_file = database_file
         self.config_file = config_file
+        
+        # Directory for on-disk caches (embeddings, indexes, database shards) next to the database
+        self.cache_dir = os.getenv(
+            'RAG_CACHE_DIR',
+            os.path.join(os.path.dirname(os.path.abspath(database_file)), 'rag_cache')
+        )
+        
         self.database = self.load_database()
         self.config = self.load_config()
         self.active_channels = [ch for ch in self.config['channels'] if ch['active']]
-        self.embedding_cache = {}  # Cache for embeddings
+        self.embedding_cache = OrderedDict()  # Query text -> normalized embedding (LRU)
+        self._embedding_cache_lock = threading.Lock()
+        self._build_alias_map()
+        self.embedding_model_id = 'all-MiniLM-L6-v2'  # Part of every embedding cache key
+        self.device = 'cpu'  # Set to 'cuda' by load_embedding_model when a GPU is available
+        
+        # Per-channel message embedding matrices, memory-mapped on first use
+        self._msg_idx = {}
+        self._msg_idx_lock = threading.Lock()
+        self._device_idx = OrderedDict()  # fp16 copies on the GPU, when one is used (LRU within GPU_INDEX_BUDGET_MB)
+        self._device_idx_lock = threading.Lock()
+        
+        # Workers for searching several channels at once (NumPy/FAISS release the GIL)
+        self._pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix='rag-search')
+        # (channel, query) -> search started before the agent asked for it
+        self._speculative = {}
+        self._speculative_lock = threading.Lock()
+        
+        # Channel -> (lowered texts, character n-gram -> message positions), built on a channel's first
+        # keyword search and kept for as many channels as LazyChannels keeps loaded
+        self._keyword_index = OrderedDict()
+        self._keyword_index_lock = threading.Lock()
         
-        # Initialize LangChain components
-        self.initialize_langchain()
+        # Event loop behind the blocking query() wrapper, driven by one thread at a time
+        self._query_loop = None
+        self._query_lock = threading.Lock()
+        self.http_client = self.http_async_client = None
+        
+        # Final answers (in memory) and per-channel search results (persisted in sqlite)
+        self._answer_cache = OrderedDict()
+        self._semantic_cache = SemanticCache()
+        self._init_result_cache()
+        
+        # The encoder, channel index and LangChain agent (and their heavy imports) load on first use,
+        # so a one-shot query answered from the cache never pays for them
+        self.llm = None
+        self.agent = None
+        self._initialized = False
+        self._init_lock = threading.Lock()
+    
+    def ensure_initialized(self):
+        """Initialize the LangChain components once, on first use"""
+        if self._initialized:
+            return
+        with self._init_lock:
+            if not self._initialized:
+                self.initialize_langchain()
+                self._initialized = True
         
     def initialize_langchain(self):
         """Initialize LangChain components"""
@@ -39,17 +347,24 @@ class LangChainRAGSystem:
             from langchain.tools import Tool
             from langchain.agents import AgentExecutor, create_openai_tools_agent
             from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
-            from sentence_transformers import SentenceTransformer
             
-            # Initialize sentence transformer for semantic search - using faster model
-            self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+            # Initialize sentence encoder for semantic search - using faster model
+            self.embedding_model = self.load_embedding_model()
+            self._load_semantic_cache()
             
-            # Initialize LLM
+            # Channel descriptions are static - embed them once instead of per query
+            self.build_channel_index()
+            
+            # Initialize LLM over pooled keep-alive connections
+            self.http_client, self.http_async_client = self.create_http_clients()
             self.llm = ChatOpenAI(
                 model="gemini-2.5-flash",
                 temperature=0.7,
+                streaming=True,
                 api_key=openai.api_key,
-                base_url=openai.base_url
+                base_url=openai.base_url,
+                http_client=self.http_client,
+                http_async_client=self.http_async_client
             )
             
             # Create tools
@@ -78,6 +393,10 @@ class LangChainRAGSystem:
             channel_username: str = Field(description="Username of the channel to search in")
             query: str = Field(description="Query to search for in the channel")
         
+        class SearchMessagesInChannelsInput(BaseModel):
+            channel_usernames: List[str] = Field(description="Usernames of the channels to search in")
+            query: str = Field(description="Query to search for in the channels")
+        
         class GetChannelInfoInput(BaseModel):
             channel_username: str = Field(description="Username of the channel to get info for")
         
@@ -88,24 +407,35 @@ class LangChainRAGSystem:
         tools = [
             StructuredTool.from_function(
                 func=self.search_relevant_channels,
+                coroutine=self._pooled(self.search_relevant_channels),
                 name="search_channels",
                 description="Search for relevant channels based on a query. Returns list of channel usernames.",
                 args_schema=SearchChannelsInput
             ),
             StructuredTool.from_function(
                 func=self.search_messages_in_channel,
+                coroutine=self._pooled(self.search_messages_in_channel),
                 name="search_messages_in_channel",
                 description="Search for messages in a specific channel. Returns relevant messages.",
                 args_schema=SearchMessagesInput
             ),
+            StructuredTool.from_function(
+                func=self.search_messages_in_channels,
+                coroutine=self.asearch_messages_in_channels,
+                name="search_messages_in_channels",
+                description="Search for messages in several channels at once. Returns relevant messages grouped by channel.",
+                args_schema=SearchMessagesInChannelsInput
+            ),
             StructuredTool.from_function(
                 func=self.get_channel_info,
+                coroutine=self._pooled(self.get_channel_info),
                 name="get_channel_info",
                 description="Get information about a specific channel. Returns channel details.",
                 args_schema=GetChannelInfoInput
             ),
             StructuredTool.from_function(
                 func=self.expand_search,
+                coroutine=self._pooled(self.expand_search),
                 name="expand_search",
                 description="Expand search to more channels if current results are insufficient. Returns additional channels.",
                 args_schema=ExpandSearchInput
@@ -133,6 +463,7 @@ class LangChainRAGSystem:
 2. سپس حداقل 2-3 کانال دیگر مرتبط را جستجو کنید
 3. اگر اطلاعات کافی نیست، با expand_search کانال‌های بیشتری اضافه کنید
 4. همیشه حداقل 3 کانال مختلف را بررسی کنید
+5. برای جستجو در چند کانال، به جای چند فراخوانی جداگانه search_messages_in_channel، یک بار search_messages_in_channels را با فهرست همه کانال‌ها فراخوانی کنید
 
 **فرمت پاسخ:**
 پاسخ خود را به این شکل ارائه دهید:
@@ -170,6 +501,7 @@ class LangChainRAGSystem:
 ابزارهای موجود:
 - search_channels: برای پیدا کردن کانال‌های مرتبط
 - search_messages_in_channel: برای جستجو در پیام‌های یک کانال
+- search_messages_in_channels: برای جستجوی هم‌زمان در پیام‌های چند کانال
 - get_channel_info: برای دریافت اطلاعات کانال
 - expand_search: برای گسترش جستجو
 
@@ -183,55 +515,516 @@ class LangChainRAGSystem:
         
         return agent_executor
     
+    @staticmethod
+    def create_http_clients():
+        """Sync and async HTTP clients that keep TLS connections to the LLM API open between calls"""
+        import httpx
+        
+        options = dict(
+            # HTTP/2 multiplexes concurrent requests over one connection; needs the h2 package
+            http2=importlib.util.find_spec('h2') is not None,
+            limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+            timeout=httpx.Timeout(60, connect=5)
+        )
+        return httpx.Client(**options), httpx.AsyncClient(**options)
+    
+    def load_embedding_model(self):
+        """Load the sentence encoder: an ONNX export if EMBEDDING_ONNX_DIR is set, else SentenceTransformer"""
+        onnx_dir = os.getenv('EMBEDDING_ONNX_DIR')
+        if onnx_dir:
+            try:
+                from onnx_encoder import OnnxSentenceEncoder
+                model = OnnxSentenceEncoder(onnx_dir)
+                # Quantized embeddings differ slightly, so they get their own cached indexes
+                self.embedding_model_id = f"onnx:{os.path.abspath(onnx_dir)}"
+                print(f"✅ Using ONNX encoder from {onnx_dir}")
+                return model
+            except Exception as e:
+                print(f"⚠️ Could not load ONNX encoder, falling back to SentenceTransformer: {e}")
+        
+        from sentence_transformers import SentenceTransformer
+        self.embedding_model_id = 'all-MiniLM-L6-v2'
+        self.device = self._select_device()
+        return SentenceTransformer('all-MiniLM-L6-v2', device=self.device)
+    
+    @staticmethod
+    def _select_device() -> str:
+        """'cuda' or Apple 'mps' if torch sees one (unless EMBEDDING_DEVICE says otherwise), else 'cpu'"""
+        requested = os.getenv('EMBEDDING_DEVICE')
+        if requested:
+            return requested
+        try:
+            import torch
+        except ImportError:
+            return 'cpu'
+        if torch.cuda.is_available():
+            return 'cuda'
+        mps = getattr(torch.backends, 'mps', None)
+        if mps is not None and mps.is_available():
+            return 'mps'
+        return 'cpu'
+    
+    def build_channel_index(self):
+        """Embed active channel descriptions once and keep them as a normalized matrix"""
+        self._channel_usernames = [ch['username'] for ch in self.active_channels]
+        self._channel_rows = {username: i for i, username in enumerate(self._channel_usernames)}
+        self._channel_texts = [f"{ch['name']} {ch['description']}" for ch in self.active_channels]
+        
+        # Key the on-disk cache by content so config edits invalidate it
+        texts_key = hashlib.sha1('\n'.join([self.embedding_model_id] + self._channel_texts).encode('utf-8')).hexdigest()
+        cache_file = os.path.join(self.cache_dir, 'channel_emb.pkl')
+        
+        try:
+            with open(cache_file, 'rb') as f:
+                cached_key, embeddings = pickle.load(f)
+            if cached_key == texts_key:
+                self._channel_embeddings = embeddings
+                print(f"✅ Loaded {len(embeddings)} cached channel embeddings")
+                return
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable channel embedding cache: {e}")
+        
+        if self._channel_texts:
+            embeddings = self.embedding_model.encode(
+                self._channel_texts,
+                batch_size=64,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            ).astype(np.float32)
+        else:
+            dim = self.embedding_model.get_sentence_embedding_dimension()
+            embeddings = np.zeros((0, dim), dtype=np.float32)
+        self._channel_embeddings = embeddings
+        
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(cache_file, 'wb') as f:
+                pickle.dump((texts_key, embeddings), f)
+        except OSError as e:
+            print(f"⚠️ Could not save channel embedding cache: {e}")
+    
+    def _channel_keyword_index(self, channel_username: str) -> Tuple[List[str], Dict[str, np.ndarray]]:
+        """Lowered texts and n-gram postings of a channel, from the in-memory LRU or built on first use"""
+        with self._keyword_index_lock:
+            index = self._keyword_index.get(channel_username)
+            if index is not None:
+                self._keyword_index.move_to_end(channel_username)
+                return index
+        
+        index = self._load_keyword_index(channel_username)
+        with self._keyword_index_lock:
+            self._keyword_index[channel_username] = index
+            self._keyword_index.move_to_end(channel_username)
+            while len(self._keyword_index) > MAX_LOADED_CHANNELS:
+                self._keyword_index.popitem(last=False)
+        return index
+    
+    def _load_keyword_index(self, channel_username: str) -> Tuple[List[str], Dict[str, np.ndarray]]:
+        """Build a channel's keyword index, reusing the postings saved for this database file"""
+        # Case-folded message texts ('' for texts too short to search)
+        texts = []
+        for msg in self.database['channels'][channel_username].get('messages', []):
+            text = msg.get('text', '')
+            texts.append(text.casefold() if text and len(text) > 10 else '')
+        
+        try:
+            stat = os.stat(self.database_file)
+            cache_key = (os.path.abspath(self.database_file), stat.st_mtime_ns, stat.st_size, _KEYWORD_INDEX_VERSION)
+        except OSError:
+            cache_key = None
+        cache_file = os.path.join(self.cache_dir, 'postings', f"{channel_username}.pkl")
+        
+        if cache_key:
+            try:
+                with open(cache_file, 'rb') as f:
+                    cached_key, postings = pickle.load(f)
+                if cached_key == cache_key:
+                    return texts, postings
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"⚠️ Ignoring unreadable keyword index cache for {channel_username}: {e}")
+        
+        postings = _build_ngram_postings(texts)
+        
+        if cache_key:
+            try:
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                with open(cache_file, 'wb') as f:
+                    pickle.dump((cache_key, postings), f, protocol=pickle.HIGHEST_PROTOCOL)
+            except OSError as e:
+                print(f"⚠️ Could not save keyword index cache for {channel_username}: {e}")
+        return texts, postings
+    
+    def _lowered_texts(self, channel_username: str) -> List[str]:
+        """Case-folded message texts for a channel ('' for texts too short to search)"""
+        return self._channel_keyword_index(channel_username)[0]
+    
+    def _keyword_candidates(self, channel_username: str, query_lower: str) -> np.ndarray:
+        """Positions of messages that may contain one of the query words as a substring"""
+        # The same words _keyword_matcher looks for; a phrase match implies each of them matches too
+        words = {word for word in query_lower.split() if len(word) > 2}
+        if not words:
+            # Nothing to look up - the matcher counts every searchable message as a match
+            return np.arange(len(self._lowered_texts(channel_username)), dtype=np.int32)
+        
+        postings = self._channel_keyword_index(channel_username)[1]
+        matched = [_substring_candidates(postings, word) for word in words]
+        return np.unique(np.concatenate(matched))
+    
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _keyword_matcher(query_lower: str):
+        """Return a function classifying a lowercased text as 3 (phrase), 2 (all words), 1 (any word) or 0"""
+        # Cached, so every channel the agent searches for the same query reuses one automaton
+        words = {word for word in query_lower.split() if len(word) > 2}
+        
+        if ahocorasick is None or not query_lower:
+            word_list = tuple(words)  # Iterated for every candidate message
+            
+            def match(text_lower: str) -> int:
+                if query_lower in text_lower:
+                    return 3
+                # One pass over the words: the first mix of found and missing decides "any word"
+                found = missing = False
+                for word in word_list:
+                    if word in text_lower:
+                        if missing:
+                            return 1
+                        found = True
+                    elif found:
+                        return 1
+                    else:
+                        missing = True
+                return 0 if missing else 2
+            return match
+        
+        # One sweep over the text finds the phrase and every word at once
+        automaton = ahocorasick.Automaton()
+        for pattern in words | {query_lower}:
+            automaton.add_word(pattern, pattern)
+        automaton.make_automaton()
+        
+        def match(text_lower: str) -> int:
+            found = {pattern for _, pattern in automaton.iter(text_lower)}
+            if query_lower in found:
+                return 3
+            if words <= found:
+                return 2
+            if words & found:
+                return 1
+            return 0
+        return match
+    
+    def warm_up(self):
+        """Initialize, then load (or build) the priority channels' message indexes on the search pool, once"""
+        if getattr(self, '_warmed_up', False):
+            return
+        self._warmed_up = True
+        self.ensure_initialized()
+        if not hasattr(self, 'embedding_model'):
+            return
+        for channel_username in ['sharifdaily', 'sharif_senfi']:
+            if channel_username in self.database['channels']:
+                self._pool.submit(self.get_message_index, channel_username)
+    
+    def prefetch_related(self, answer: str):
+        """Load the message indexes of channels an answer cites, ahead of likely follow-up questions"""
+        if not hasattr(self, 'embedding_model'):
+            return
+        for cited in dict.fromkeys(_MESSAGE_LINK_RE.findall(answer)):
+            channel_username = self.resolve_channel(cited)
+            if channel_username:
+                self.get_message_index(channel_username)
+    
+    def build_message_index(self, channels: Optional[List[str]] = None):
+        """Precompute message embeddings for the given channels (all by default)"""
+        self.ensure_initialized()
+        for channel_username in channels or list(self.database['channels'].keys()):
+            self._msg_idx[channel_username] = self._load_message_index(channel_username)
+    
+    def get_message_index(self, channel_username: str) -> Tuple[np.ndarray, np.ndarray, Any, Optional[np.ndarray]]:
+        """Get (embedding matrix, message positions, ANN index or None, int8 scale or None) for a channel"""
+        index = self._msg_idx.get(channel_username)
+        if index is None:
+            # Search threads may ask for the same channel at once - build it only once
+            with self._msg_idx_lock:
+                index = self._msg_idx.get(channel_username)
+                if index is None:
+                    index = self._load_message_index(channel_username)
+                    self._msg_idx[channel_username] = index
+        return index
+    
+    def _load_message_index(self, channel_username: str) -> Tuple[np.ndarray, np.ndarray, Any, Optional[np.ndarray]]:
+        """Load a channel's message embeddings from disk, re-encoding if the messages changed"""
+        base_path = os.path.join(self.cache_dir, 'idx', channel_username)
+        # Saved with the index: its content hash, then the database file it was built from
+        db_stamp = f"{self.embedding_model_id}:{EMBED_DTYPE}:{self._db_version!r}"
+        try:
+            with open(base_path + '.hash', 'r', encoding='utf-8') as f:
+                saved_key, _, saved_stamp = f.read().strip().partition('\n')
+        except OSError:
+            saved_key = saved_stamp = None
+        
+        # Unchanged database file: load without reading or hashing the channel's messages
+        if self._db_version and saved_stamp == db_stamp:
+            try:
+                return self._open_message_index(base_path)
+            except Exception as e:
+                print(f"⚠️ Rebuilding unreadable index for {channel_username}: {e}")
+        
+        messages = self.database['channels'][channel_username].get('messages', [])
+        
+        # Only longer texts are worth a semantic match
+        positions = [i for i, msg in enumerate(messages) if len(msg.get('text', '') or '') > 30]
+        texts = [messages[i]['text'][:200] for i in positions]  # Limit text length
+        
+        content_key = hashlib.sha1('\x00'.join([self.embedding_model_id] + texts).encode('utf-8')).hexdigest() + ':' + EMBED_DTYPE
+        
+        if saved_key == content_key:
+            try:
+                index = self._open_message_index(base_path)
+                self._write_index_hash(base_path, content_key, db_stamp)
+                return index
+            except Exception as e:
+                print(f"⚠️ Rebuilding unreadable index for {channel_username}: {e}")
+        
+        print(f"   🔍 محاسبه embedding برای {len(texts)} پیام کانال {channel_username}...")
+        if texts:
+            matrix = self.embedding_model.encode(
+                texts,
+                batch_size=128 if self.device == 'cpu' else 256,  # Larger batches keep a GPU busy
+                show_progress_bar=True,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            ).astype(np.float32)
+        else:
+            dim = self.embedding_model.get_sentence_embedding_dimension()
+            matrix = np.zeros((0, dim), dtype=np.float32)
+        positions = np.asarray(positions, dtype=np.int32)
+        ann_index = self._build_ann_index(matrix)
+        matrix, scale = self._quantize_embeddings(matrix)
+        # Shared read-only between search threads, like the memory-mapped copies
+        matrix.flags.writeable = False
+        
+        try:
+            os.makedirs(os.path.dirname(base_path), exist_ok=True)
+            np.save(base_path + '.npy', matrix)
+            np.save(base_path + '_ids.npy', positions)
+            if scale is not None:
+                np.save(base_path + '_scale.npy', scale)
+            if ann_index is not None:
+                faiss.write_index(ann_index, base_path + '.faiss')
+            # Written last so a partial save is never mistaken for a valid index
+            self._write_index_hash(base_path, content_key, db_stamp)
+        except OSError as e:
+            print(f"⚠️ Could not save message index for {channel_username}: {e}")
+        
+        return matrix, positions, ann_index, scale
+    
+    def _open_message_index(self, base_path: str) -> Tuple[np.ndarray, np.ndarray, Any, Optional[np.ndarray]]:
+        """Memory-map a saved message index"""
+        matrix = np.load(base_path + '.npy', mmap_mode='r')
+        scale = np.load(base_path + '_scale.npy') if EMBED_DTYPE == 'int8' else None
+        ann_index = self._load_ann_index(base_path, matrix, scale)
+        return matrix, np.load(base_path + '_ids.npy'), ann_index, scale
+    
+    @staticmethod
+    def _write_index_hash(base_path: str, content_key: str, db_stamp: str):
+        with open(base_path + '.hash', 'w', encoding='utf-8') as f:
+            f.write(f"{content_key}\n{db_stamp}")
+    
+    @staticmethod
+    def _quantize_embeddings(matrix: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Convert a float32 embedding matrix to the EMBED_DTYPE storage type"""
+        if EMBED_DTYPE == 'fp16':
+            return matrix.astype(np.float16), None
+        if EMBED_DTYPE == 'int8':
+            # Per-dimension scale so every column uses the full int8 range
+            scale = (127.0 / np.maximum(np.abs(matrix).max(axis=0), 1e-12)).astype(np.float32) if len(matrix) else np.ones(matrix.shape[1], dtype=np.float32)
+            return np.round(matrix * scale).astype(np.int8), scale
+        return matrix, None
+    
+    @staticmethod
+    def _dequantize_embeddings(matrix: np.ndarray, scale: Optional[np.ndarray]) -> np.ndarray:
+        """Float32 view of (a slice of) a stored embedding matrix"""
+        matrix = np.asarray(matrix, dtype=np.float32)
+        return matrix / scale if scale is not None else matrix
+    
+    @staticmethod
+    def _score_embeddings(matrix: np.ndarray, scale: Optional[np.ndarray], query_embedding: np.ndarray) -> np.ndarray:
+        """Dot product of every stored row with the query, whatever the storage type"""
+        if matrix.dtype == np.float32:
+            return matrix @ query_embedding
+        
+        # Fold the int8 scale into the query instead of rescaling the matrix
+        query = (query_embedding / scale if scale is not None else query_embedding).astype(np.float32)
+        scores = np.empty(len(matrix), dtype=np.float32)
+        block = 8192  # Upcast in blocks so the float32 copy stays cache-sized
+        for start in range(0, len(matrix), block):
+            scores[start:start + block] = matrix[start:start + block].astype(np.float32) @ query
+        return scores
+    
+    @staticmethod
+    def _wants_ann_index(count: int) -> bool:
+        """Whether a channel with count embedded messages is searched through a FAISS index"""
+        # int8 storage always is: FAISS scans 8-bit codes with SIMD, faster than upcasting in numpy
+        return faiss is not None and (count >= ANN_MIN_MESSAGES or (EMBED_DTYPE == 'int8' and count > 0))
+    
+    def _build_ann_index(self, matrix: np.ndarray):
+        """Build a FAISS index for a large (or int8-stored) embedding matrix (None if not worth it)"""
+        if not self._wants_ann_index(len(matrix)):
+            return None
+        
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        dim = matrix.shape[1]
+        if len(matrix) >= IVFPQ_MIN_MESSAGES and dim % 48 == 0:
+            # 48 one-byte codes per vector instead of 384 floats
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFPQ(quantizer, dim, 256, 48, 8, faiss.METRIC_INNER_PRODUCT)
+            index.train(matrix)
+            index.nprobe = 16
+        elif len(matrix) >= ANN_MIN_MESSAGES:
+            index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = 80
+        else:
+            # Exhaustive scan over one-byte-per-dimension codes
+            index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+            index.train(matrix)
+        index.add(matrix)
+        return index
+    
+    def _load_ann_index(self, base_path: str, matrix: np.ndarray, scale: Optional[np.ndarray]):
+        """Load a channel's FAISS index from disk, rebuilding it if missing"""
+        if not self._wants_ann_index(len(matrix)):
+            return None
+        
+        path = base_path + '.faiss'
+        if os.path.exists(path):
+            try:
+                return faiss.read_index(path, faiss.IO_FLAG_MMAP)
+            except RuntimeError:
+                # Not every index type supports mmap - fall back to a normal read
+                return faiss.read_index(path)
+        
+        index = self._build_ann_index(self._dequantize_embeddings(matrix, scale))
+        try:
+            faiss.write_index(index, path)
+        except RuntimeError as e:
+            print(f"⚠️ Could not save ANN index: {e}")
+        return index
+    
+    def _encode_query(self, query: str) -> np.ndarray:
+        """Normalized embedding of a query, reused across tool calls for the same text"""
+        # Case, spacing and Unicode-form variants of a query share one embedding
+        query = normalize_query(query)
+        with self._embedding_cache_lock:
+            embedding = self.embedding_cache.get(query)
+            if embedding is not None:
+                self.embedding_cache.move_to_end(query)
+                return embedding
+        
+        # float32 and contiguous once here, so every scoring path gets an SGEMV with no copies
+        embedding = np.ascontiguousarray(
+            self.embedding_model.encode(query, convert_to_numpy=True, normalize_embeddings=True), dtype=np.float32
+        )
+        embedding.flags.writeable = False  # Shared between callers
+        
+        with self._embedding_cache_lock:
+            self.embedding_cache[query] = embedding
+            if len(self.embedding_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+                self.embedding_cache.popitem(last=False)
+        return embedding
+    
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        """Normalized embeddings of many queries in one batched forward pass"""
+        self.ensure_initialized()
+        embeddings = np.ascontiguousarray(self.embedding_model.encode(
+            queries, batch_size=64, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False
+        ), dtype=np.float32)
+        embeddings.flags.writeable = False
+        return embeddings
+    
+    def _device_matrix(self, channel_username: str, matrix: np.ndarray, scale: Optional[np.ndarray]):
+        """Channel embeddings as an fp16 tensor resident on self.device, or None if it exceeds the GPU budget"""
+        with self._device_idx_lock:
+            tensor = self._device_idx.get(channel_username)
+            if tensor is not None:
+                self._device_idx.move_to_end(channel_username)
+                return tensor
+        
+        budget = GPU_INDEX_BUDGET_MB * 1024 * 1024
+        if matrix.shape[0] * matrix.shape[1] * 2 > budget:
+            return None
+        
+        import torch
+        host = np.array(self._dequantize_embeddings(matrix, scale), dtype=np.float32)
+        tensor = torch.from_numpy(host).to(self.device).half()
+        with self._device_idx_lock:
+            self._device_idx[channel_username] = tensor
+            self._device_idx.move_to_end(channel_username)
+            # Evicted tensors are freed once no running search still holds them
+            used = sum(t.numel() * t.element_size() for t in self._device_idx.values())
+            while used > budget:
+                _, evicted = self._device_idx.popitem(last=False)
+                used -= evicted.numel() * evicted.element_size()
+        return tensor
+    
+    def _nearest_messages(self, channel_username: str, query_embedding: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k (similarities, message positions) for a normalized query embedding, best first"""
+        matrix, positions, ann_index, scale = self.get_message_index(channel_username)
+        if not len(positions):
+            return np.zeros(0, dtype=np.float32), positions
+        
+        corpus = self._device_matrix(channel_username, matrix, scale) if self.device != 'cpu' else None
+        if corpus is not None:
+            # Scoring and top-k both run on the GPU; only k hits come back to the host
+            import torch
+            from sentence_transformers import util
+            query = torch.from_numpy(np.asarray(query_embedding, dtype=np.float32)).to(self.device).half()
+            hits = util.semantic_search(query[None, :], corpus, top_k=k, score_function=util.dot_score)[0]
+            sims = np.array([hit['score'] for hit in hits], dtype=np.float32)
+            rows = np.array([hit['corpus_id'] for hit in hits], dtype=np.int64)
+            return sims, positions[rows]
+        
+        if ann_index is not None:
+            if hasattr(ann_index, 'hnsw'):
+                ann_index.hnsw.efSearch = max(64, k)
+            _, rows = ann_index.search(np.asarray(query_embedding, dtype=np.float32)[None, :], k)
+            rows = np.sort(rows[0][rows[0] >= 0])  # FAISS pads with -1 when fewer than k hits
+            # Re-score the candidates exactly (PQ distances are approximate); only k rows are read
+            sims = self._dequantize_embeddings(matrix[rows], scale) @ query_embedding
+            order = np.argsort(-sims)
+            return sims[order], positions[rows[order]]
+        
+        sims = self._score_embeddings(matrix, scale, query_embedding)
+        rows = self.top_k_indices(sims, k)
+        return sims[rows], positions[rows]
+    
     def search_relevant_channels(self, query: str) -> str:
         """Search for relevant channels based on query with priority channels"""
         try:
             # Priority channels that should always be checked first
             priority_channels = ['sharifdaily', 'sharif_senfi']
             
-            # Use semantic search to find relevant channels
-            query_embedding = self.embedding_model.encode(query)
-            
-            channel_scores = []
-            priority_found = []
+            # Start with priority channels (if they exist in active channels)
+            result_channels = [ch for ch in priority_channels if ch in self._channel_rows]
             
-            # Batch encode channel texts for better performance
-            channel_texts = []
-            channel_names = []
-            
-            for channel in self.active_channels:
-                channel_text = f"{channel['name']} {channel['description']}"
-                channel_texts.append(channel_text)
-                channel_names.append(channel['username'])
-                
-                # Check if it's a priority channel
-                if channel['username'] in priority_channels:
-                    priority_found.append(channel['username'])
-            
-            # Batch encode all channel texts at once
-            if channel_texts:
-                channel_embeddings = self.embedding_model.encode(channel_texts)
-                
-                for i, username in enumerate(channel_names):
-                    similarity = self.cosine_similarity(query_embedding, channel_embeddings[i])
-                    channel_scores.append((username, similarity))
-            
-            # Sort by similarity
-            channel_scores.sort(key=lambda x: x[1], reverse=True)
-            
-            # Start with priority channels, then add top semantic matches
-            result_channels = []
-            
-            # Add priority channels first (if they exist in active channels)
-            for priority_ch in priority_channels:
-                if priority_ch in priority_found:
-                    result_channels.append(priority_ch)
+            # Rows are L2-normalized, so a single dot product gives cosine similarity
+            query_embedding = self._encode_query(query)
+            scores = self._channel_embeddings @ query_embedding
             
             # Add top semantic matches (excluding priority channels already added)
-            for username, score in channel_scores:
+            for i in self.top_k_indices(scores, 8 + len(result_channels)):
+                username = self._channel_usernames[i]
                 if username not in result_channels and len(result_channels) < 8:  # Keep total around 10
                     result_channels.append(username)
             
+            # The agent usually searches these next with the same query
+            self._speculate_searches(result_channels, query)
+            
             return f"کانال‌های مرتبط (اولویت + معنایی): {', '.join(result_channels)}"
             
         except Exception as e:
@@ -239,196 +1032,435 @@ class LangChainRAGSystem:
     
 
     
+    def _init_result_cache(self):
+        """Open the sqlite store backing the (channel, query) -> result and question -> answer caches"""
+        self._tool_cache = OrderedDict()  # (channel, query) -> (created_at, result), LRU
+        self._cache_lock = threading.Lock()
+        # Results are only valid for the database snapshot they were computed from
+        self._db_version = os.path.getmtime(self.database_file) if os.path.exists(self.database_file) else 0.0
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._cache_db = sqlite3.connect(os.path.join(self.cache_dir, 'results.db'), check_same_thread=False)
+            self._cache_db.execute('''
+                CREATE TABLE IF NOT EXISTS tool_cache (
+                    channel TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    db_mtime REAL NOT NULL,
+                    created_at REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (channel, query)
+                )
+            ''')
+            # Stores from before results expired have no created_at; their rows count as expired
+            if 'created_at' not in {row[1] for row in self._cache_db.execute('PRAGMA table_info(tool_cache)')}:
+                self._cache_db.execute('ALTER TABLE tool_cache ADD COLUMN created_at REAL NOT NULL DEFAULT 0')
+            self._cache_db.execute('''
+                CREATE TABLE IF NOT EXISTS answer_cache (
+                    question TEXT PRIMARY KEY,
+                    answer TEXT NOT NULL,
+                    db_mtime REAL NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            self._cache_db.execute('''
+                CREATE TABLE IF NOT EXISTS semantic_cache (
+                    question TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    answer TEXT NOT NULL,
+                    db_mtime REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (question, model)
+                )
+            ''')
+            # Drop results computed against an older database file, and expired paraphrase entries
+            self._cache_db.execute(
+                'DELETE FROM tool_cache WHERE db_mtime != ? OR created_at < ?',
+                (self._db_version, time.time() - TOOL_CACHE_TTL)
+            )
+            self._cache_db.execute('DELETE FROM answer_cache WHERE db_mtime != ?', (self._db_version,))
+            self._cache_db.execute(
+                'DELETE FROM semantic_cache WHERE db_mtime != ? OR created_at < ?',
+                (self._db_version, time.time() - self._semantic_cache.ttl)
+            )
+            self._cache_db.commit()
+            # Only the newest results are loaded back, oldest first to match the LRU order
+            for channel, query, result, created_at in self._cache_db.execute(
+                'SELECT channel, query, result, created_at FROM '
+                '(SELECT * FROM tool_cache ORDER BY created_at DESC LIMIT ?) ORDER BY created_at',
+                (TOOL_CACHE_SIZE,)
+            ):
+                self._tool_cache[(channel, query)] = (created_at, result)
+            # Most recent answers last, matching the LRU order
+            for question, answer in self._cache_db.execute(
+                'SELECT question, answer FROM (SELECT * FROM answer_cache ORDER BY created_at DESC LIMIT ?) ORDER BY created_at',
+                (ANSWER_CACHE_SIZE,)
+            ):
+                self._answer_cache[question] = answer
+        except sqlite3.Error as e:
+            print(f"⚠️ کش نتایج در دسترس نیست: {e}")
+            self._cache_db = None
+    
+    def _cached_tool_result(self, key: Tuple[str, str]) -> Optional[str]:
+        """A stored search result that has not expired, if any"""
+        with self._cache_lock:
+            entry = self._tool_cache.get(key)
+            if entry is None:
+                return None
+            created_at, result = entry
+            if created_at < time.time() - TOOL_CACHE_TTL:
+                del self._tool_cache[key]
+                return None
+            self._tool_cache.move_to_end(key)
+            return result
+    
+    def _store_tool_result(self, key: Tuple[str, str], result: str):
+        """Remember a search result in the in-memory LRU and on disk"""
+        created_at = time.time()
+        with self._cache_lock:
+            self._tool_cache[key] = (created_at, result)
+            self._tool_cache.move_to_end(key)
+            if len(self._tool_cache) > TOOL_CACHE_SIZE:
+                self._tool_cache.popitem(last=False)
+            if self._cache_db is None:
+                return
+            try:
+                self._cache_db.execute(
+                    'INSERT OR REPLACE INTO tool_cache (channel, query, result, db_mtime, created_at) VALUES (?, ?, ?, ?, ?)',
+                    (key[0], key[1], result, self._db_version, created_at)
+                )
+                self._cache_db.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ خطا در ذخیره کش: {e}")
+    
+    def _store_answer(self, key: str, answer: str):
+        """Remember a final answer in the in-memory LRU and on disk"""
+        with self._cache_lock:
+            self._answer_cache[key] = answer
+            self._answer_cache.move_to_end(key)
+            if len(self._answer_cache) > ANSWER_CACHE_SIZE:
+                self._answer_cache.popitem(last=False)
+            if self._cache_db is None:
+                return
+            try:
+                self._cache_db.execute(
+                    'INSERT OR REPLACE INTO answer_cache (question, answer, db_mtime, created_at) VALUES (?, ?, ?, ?)',
+                    (key, answer, self._db_version, time.time())
+                )
+                self._cache_db.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ خطا در ذخیره کش: {e}")
+    
+    def sweep_caches(self):
+        """Evict expired semantic entries and search results, and trim the stored ones to what is ever loaded back"""
+        cutoff = time.time() - self._semantic_cache.ttl
+        self._semantic_cache.evict_older_than(cutoff)
+        tool_cutoff = time.time() - TOOL_CACHE_TTL
+        with self._cache_lock:
+            for key in [key for key, (created_at, _) in self._tool_cache.items() if created_at < tool_cutoff]:
+                del self._tool_cache[key]
+            if self._cache_db is None:
+                return
+            try:
+                self._cache_db.execute(
+                    'DELETE FROM semantic_cache WHERE created_at < ? OR rowid NOT IN '
+                    '(SELECT rowid FROM semantic_cache ORDER BY created_at DESC LIMIT ?)',
+                    (cutoff, self._semantic_cache.max_entries)
+                )
+                self._cache_db.execute(
+                    'DELETE FROM answer_cache WHERE rowid NOT IN '
+                    '(SELECT rowid FROM answer_cache ORDER BY created_at DESC LIMIT ?)',
+                    (ANSWER_CACHE_SIZE,)
+                )
+                self._cache_db.execute(
+                    'DELETE FROM tool_cache WHERE created_at < ? OR rowid NOT IN '
+                    '(SELECT rowid FROM tool_cache ORDER BY created_at DESC LIMIT ?)',
+                    (tool_cutoff, TOOL_CACHE_SIZE)
+                )
+                self._cache_db.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ خطا در پاک‌سازی کش: {e}")
+    
+    def start_cache_sweeper(self, interval: float = 3600):
+        """Run sweep_caches every interval seconds on a daemon thread"""
+        def sweeper():
+            while True:
+                time.sleep(interval)
+                self.sweep_caches()
+        
+        threading.Thread(target=sweeper, name='cache-sweeper', daemon=True).start()
+    
+    def _load_semantic_cache(self):
+        """Fill the semantic cache with stored entries embedded by the current model"""
+        if self._cache_db is None:
+            return
+        with self._cache_lock:
+            rows = self._cache_db.execute(
+                'SELECT embedding, answer, created_at FROM semantic_cache WHERE model = ? ORDER BY created_at',
+                (self.embedding_model_id,)
+            ).fetchall()
+        for embedding, answer, created_at in rows:
+            self._semantic_cache.add(np.frombuffer(embedding, dtype=np.float32), answer, created_at)
+    
+    def _store_semantic(self, key: str, embedding: np.ndarray, answer: str):
+        """Remember an answer for paraphrase lookups in memory and on disk"""
+        created_at = time.time()
+        self._semantic_cache.add(embedding, answer, created_at)
+        with self._cache_lock:
+            if self._cache_db is None:
+                return
+            try:
+                self._cache_db.execute(
+                    'INSERT OR REPLACE INTO semantic_cache (question, model, embedding, answer, db_mtime, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, self.embedding_model_id, np.asarray(embedding, dtype=np.float32).tobytes(), answer, self._db_version, created_at)
+                )
+                self._cache_db.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ خطا در ذخیره کش: {e}")
+    
+    def _build_alias_map(self):
+        """Map lowercased channel names, their variants and known aliases to database usernames"""
+        self._alias_map = {}
+        self._resolved_channels = {}
+        channels = list(self.database['channels'].keys())
+        
+        for canonical in channels:
+            self._alias_map.setdefault(canonical.lower(), canonical)
+        for canonical in channels:
+            self._alias_map.setdefault(canonical.lower().replace('_', ''), canonical)
+        
+        # A name's first segment is only an alias when no other channel shares it
+        first_segments = defaultdict(list)
+        for canonical in channels:
+            first_segments[canonical.lower().split('_')[0]].append(canonical)
+        for segment, owners in first_segments.items():
+            if len(owners) == 1:
+                self._alias_map.setdefault(segment, owners[0])
+        
+        # Hand-written aliases first, then real usernames, for substring matches
+        self._partial_aliases = []
+        for alias, canonical in _CHANNEL_ALIASES.items():
+            if canonical in self.database['channels']:
+                self._alias_map.setdefault(alias, canonical)
+                self._partial_aliases.append((alias, canonical))
+        self._partial_aliases.extend((canonical.lower(), canonical) for canonical in channels)
+        # Choices for fuzzy matching, built once rather than per lookup
+        self._alias_names = list(self._alias_map)
+    
+    def resolve_channel(self, channel_username: str) -> Optional[str]:
+        """Database username for a channel name the agent used, or None if nothing is close"""
+        if channel_username in self.database['channels']:
+            return channel_username
+        if channel_username in self._resolved_channels:
+            return self._resolved_channels[channel_username]
+        
+        name = channel_username.lower()
+        canonical = self._alias_map.get(name) or self._alias_map.get(name.replace('_', ''))
+        
+        if canonical is None:
+            # Partial matches against aliases, then against real usernames
+            canonical = next((target for alias, target in self._partial_aliases
+                              if alias in name or name in alias), None)
+        
+        if canonical is None and fuzz_process is not None:
+            match = fuzz_process.extractOne(name, self._alias_names, scorer=fuzz.WRatio, score_cutoff=80)
+            if match:
+                canonical = self._alias_map[match[0]]
+        
+        self._resolved_channels[channel_username] = canonical
+        return canonical
+    
     def search_messages_in_channel(self, channel_username: str, query: str) -> str:
         """Search for messages in a specific channel"""
         try:
-            # Handle channel name variations and fuzzy matching
-            if channel_username not in self.database['channels']:
-                # Try to find similar channel names
-                available_channels = list(self.database['channels'].keys())
-                similar_channels = []
-                
-                # Check for common variations
-                variations = {
-                    'یاریگران': 'yarigaran_sharif',
-                    'yaregaran': 'yarigaran_sharif',  # Common misspelling
-                    'yareegaran': 'yarigaran_sharif',  # Another common misspelling
-                    'yari': 'yarigaran_sharif',
-                    'شریف': 'sharif_senfi',
-                    'شورای صنفی': 'sharif_senfi',
-                    'روزنامه': 'sharifdaily',
-                    'daily': 'sharifdaily'
-                }
-                
-                # Check if there's a direct variation match
-                if channel_username in variations:
-                    suggested_channel = variations[channel_username]
-                    if suggested_channel in self.database['channels']:
-                        # Automatically search in the suggested channel instead of just suggesting
-                        print(f"🔄 Redirecting from '{channel_username}' to '{suggested_channel}'")
-                        return self.search_messages_in_channel(suggested_channel, query)
-                
-                # Also check for partial matches in variations
-                for variation, suggested_channel in variations.items():
-                    if variation in channel_username or channel_username in variation:
-                        if suggested_channel in self.database['channels']:
-                            print(f"🔄 Redirecting from '{channel_username}' to '{suggested_channel}' (partial match)")
-                            return self.search_messages_in_channel(suggested_channel, query)
-                
-                # Find similar channel names
-                for available in available_channels:
-                    if channel_username.lower() in available.lower() or available.lower() in channel_username.lower():
-                        similar_channels.append(available)
-                
-                # Check if there's a very close match that we should automatically redirect to
-                if similar_channels:
-                    # If we have a very close match, automatically redirect
-                    best_match = similar_channels[0]
-                    if (channel_username.lower() in best_match.lower() or 
-                        best_match.lower() in channel_username.lower() or
-                        any(variation in channel_username.lower() for variation in ['یاریگران', 'yaregaran', 'yareegaran', 'yari'])):
-                        print(f"🔄 Auto-redirecting from '{channel_username}' to '{best_match}'")
-                        return self.search_messages_in_channel(best_match, query)
-                
-                # Only show error if no automatic redirect was possible
-                error_msg = f"کانال '{channel_username}' در دیتابیس موجود نیست."
-                
-                if similar_channels:
-                    error_msg += f"\n\nکانال‌های مشابه موجود:\n"
-                    for ch in similar_channels[:5]:  # Show up to 5 suggestions
-                        error_msg += f"• {ch}\n"
-                
-                error_msg += f"\n\nکانال‌های اصلی موجود:\n"
-                main_channels = ['sharif_senfi', 'sharifdaily', 'yarigaran_sharif', 'sh_counseling']
-                for ch in main_channels:
-                    if ch in available_channels:
-                        error_msg += f"• {ch}\n"
-                
-                return error_msg
+            key = (channel_username, normalize_query(query))
+            cached = self._cached_tool_result(key)
+            if cached is not None:
+                return cached
             
-            channel_data = self.database['channels'][channel_username]
-            messages = channel_data.get('messages', [])
+            # Join a speculative search already running; one still queued is run here instead
+            with self._speculative_lock:
+                future = self._speculative.pop(key, None)
+            if future is not None and not future.cancel():
+                return future.result()
+            
+            return self._run_search(key, channel_username, query)
+            
+        except Exception as e:
+            return f"خطا در جستجوی پیام‌ها: {e}"
+    
+    def _run_search(self, key: Tuple[str, str], channel_username: str, query: str) -> str:
+        result = self._search_messages_in_channel(channel_username, query)
+        self._store_tool_result(key, result)
+        return result
+    
+    def _speculate_searches(self, channel_usernames: List[str], query: str):
+        """Start searching the channels the agent is about to search, so its calls find results ready"""
+        normalized = normalize_query(query)
+        # Unexpired stored results need no search (checked before taking the speculation lock)
+        misses = [(channel_username, normalized) for channel_username in channel_usernames
+                  if self._cached_tool_result((channel_username, normalized)) is None]
+        started = []
+        with self._speculative_lock:
+            for key in misses:
+                if key in self._speculative:
+                    continue
+                self._speculative[key] = future = self._pool.submit(self._run_search, key, key[0], query)
+                started.append((key, future))
+        
+        # Outside the lock: a callback runs at once if its search already finished
+        for key, future in started:
+            future.add_done_callback(lambda done, key=key: self._forget_speculation(key, done))
+    
+    def _forget_speculation(self, key: Tuple[str, str], future):
+        with self._speculative_lock:
+            if self._speculative.get(key) is future:
+                del self._speculative[key]
+    
+    def _search_messages_in_channel(self, channel_username: str, query: str) -> str:
+        """Uncached keyword + semantic search over one channel"""
+        # Handle channel name variations and fuzzy matching
+        canonical = self.resolve_channel(channel_username)
+        if canonical is None:
+            error_msg = f"کانال '{channel_username}' در دیتابیس موجود نیست."
             
-            # Search through ALL messages (no limit)
-            print(f"🔍 جستجو در کل {len(messages)} پیام کانال {channel_username}...")
+            error_msg += f"\n\nکانال‌های اصلی موجود:\n"
+            main_channels = ['sharif_senfi', 'sharifdaily', 'yarigaran_sharif', 'sh_counseling']
+            for ch in main_channels:
+                if ch in self.database['channels']:
+                    error_msg += f"• {ch}\n"
             
-            if not messages:
-                return f"هیچ پیامی در کانال {channel_username} یافت نشد"
+            return error_msg
+        
+        if canonical != channel_username:
+            # Search the matching channel directly instead of just suggesting it
+            logger.debug("🔄 Redirecting from '%s' to '%s'", channel_username, canonical)
+            channel_username = canonical
+        
+        channel_data = self.database['channels'][channel_username]
+        messages = channel_data.get('messages', [])
+        
+        # Search through ALL messages (no limit)
+        logger.debug("🔍 جستجو در کل %d پیام کانال %s...", len(messages), channel_username)
+        
+        if not messages:
+            return f"هیچ پیامی در کانال {channel_username} یافت نشد"
+        
+        # Fast keyword search through ALL messages
+        query_lower = query.casefold()
+        query_words = query_lower.split()
+        message_scores = []
+        
+        # Candidates hold every n-gram of some query word, so no message the rules below match is left out
+        candidates = self._keyword_candidates(channel_username, query_lower)
+        texts_lower = self._lowered_texts(channel_username)
+        
+        logger.debug("🔍 جستجوی کلیدواژه در %d پیام کاندید از %d پیام...", len(candidates), len(messages))
+        match = self._keyword_matcher(query_lower)
+        show_progress = logger.isEnabledFor(logging.DEBUG)
+        
+        # Every candidate is classified: stopping early let a run of weaker matches crowd out later exact ones
+        hits_by_level = ([], [], [], [])
+        for n, i in enumerate(candidates.tolist()):
+            if show_progress and not n & 0x7FF:  # Progress indicator every 2048 messages
+                logger.debug("   پیشرفت: %d/%d (%.1f%%)", n, len(candidates), n / len(candidates) * 100)
             
-            # Fast keyword search through ALL messages
-            query_words = query.lower().split()
-            message_scores = []
+            text_lower = texts_lower[i]
+            if text_lower:
+                hits_by_level[match(text_lower)].append(i)
+        
+        logger.debug("   ✅ %d تطبیق دقیق، %d تطبیق همه کلمات، %d تطبیق جزئی",
+                     len(hits_by_level[3]), len(hits_by_level[2]), len(hits_by_level[1]))
+        # Exact phrase, then all words, then any word; message order within each level
+        for level, score in ((3, 0.95), (2, 0.8), (1, 0.6)):
+            message_scores.extend((messages[i], score) for i in hits_by_level[level])
+        
+        # Keyword hits all score above 0.5, so they all count as relevant
+        relevant_count = len(message_scores)
+        
+        # If still not enough results, do semantic search on ALL messages
+        if len(message_scores) < 10:
+            logger.debug("🔍 جستجوی معنایی در کل پیام‌ها...")
+            # One query encode, then a matmul or ANN lookup against the precomputed index
+            query_embedding = self._encode_query(query)
+            sims, hit_positions = self._nearest_messages(channel_username, query_embedding, 50)
             
-            print(f"🔍 جستجوی کلیدواژه در {len(messages)} پیام...")
-            found_exact = 0
-            found_all_words = 0
+            # Hits come best first, so those above the threshold are a prefix (at most 20)
+            semantic_found = min(int(np.count_nonzero(sims > 0.4)), 20)
+            sims = sims[:semantic_found].tolist()
+            hit_positions = hit_positions[:semantic_found].tolist()
+            message_scores.extend(zip([messages[position] for position in hit_positions], sims))
             
-            for i, msg in enumerate(messages):
-                if i % 2000 == 0:  # Progress indicator every 2000 messages
-                    print(f"   پیشرفت: {i}/{len(messages)} ({i/len(messages)*100:.1f}%)")
-                
-                text = msg.get('text', '')
-                if text and len(text) > 10:
-                    text_lower = text.lower()
-                    
-                    # Check for exact phrase match first (highest priority)
-                    if query.lower() in text_lower:
-                        score = 0.95
-                        message_scores.append((msg, score))
-                        found_exact += 1
-                        # Early termination if we have enough exact matches
-                        if found_exact >= 20:
-                            print(f"   ✅ {found_exact} تطبیق دقیق یافت شد - توقف زودهنگام")
-                            break
-                    # Check for all words present (medium priority)
-                    elif all(word in text_lower for word in query_words if len(word) > 2):
-                        score = 0.8
-                        message_scores.append((msg, score))
-                        found_all_words += 1
-                        # Early termination if we have enough good matches
-                        if found_all_words >= 50:
-                            print(f"   ✅ {found_all_words} تطبیق خوب یافت شد - توقف زودهنگام")
-                            break
-                    # Check for partial matches (lower priority)
-                    elif any(word in text_lower for word in query_words if len(word) > 2):
-                        score = 0.6
-                        message_scores.append((msg, score))
-            
-            # If still not enough results, do semantic search on ALL messages
-            if len(message_scores) < 10:
-                print("🔍 جستجوی معنایی در کل پیام‌ها...")
-                query_embedding = self.embedding_model.encode(query)
-                
-                semantic_candidates = []
-                for msg in messages:
-                    text = msg.get('text', '')
-                    if text and len(text) > 30:  # Only longer texts
-                        semantic_candidates.append((msg, text[:200]))  # Limit text length
-                
-                if semantic_candidates:
-                    print(f"   🔍 محاسبه embedding برای {len(semantic_candidates)} پیام...")
-                    texts_to_encode = [text for _, text in semantic_candidates]
-                    embeddings = self.embedding_model.encode(texts_to_encode)
-                    
-                    semantic_found = 0
-                    for i, (msg, _) in enumerate(semantic_candidates):
-                        similarity = self.cosine_similarity(query_embedding, embeddings[i])
-                        if similarity > 0.4:  # Higher threshold
-                            message_scores.append((msg, similarity))
-                            semantic_found += 1
-                            if semantic_found >= 20:  # Limit semantic results
-                                break
-                    
-                    print(f"   ✅ {semantic_found} نتیجه معنایی یافت شد")
-            
-            # Sort by similarity
-            message_scores.sort(key=lambda x: x[1], reverse=True)
-            
-            # Check if we found relevant information (similarity > 0.3 for keyword matches, 0.5 for semantic)
-            relevant_messages = [msg for msg, score in message_scores if score > 0.5 or (score > 0.3 and any(word in msg.get('text', '').lower() for word in query.lower().split()))]
-            
-            result = f"پیام‌های مرتبط در کانال {channel_username}:\n\n"
-            
-            if relevant_messages:
-                # Limit to top 15 most relevant messages to avoid overwhelming responses
-                top_messages = message_scores[:15]
-                result += f"✅ اطلاعات مرتبط یافت شد! ({len(top_messages)} پیام از {len(relevant_messages)} پیام مرتبط)\n\n"
-                
-                for i, (msg, score) in enumerate(top_messages, 1):
-                    text = msg.get('text', '')[:300]  # Show more text
-                    date = msg.get('date', 'نامشخص')
-                    msg_id = msg.get('id', 'نامشخص')
-                    channel_username = msg.get('channel', msg.get('channel_name', channel_username))
-                    
-                    result += f"{i}. امتیاز: {score:.3f} | تاریخ: {date}\n"
-                    result += f"   متن: {text}"
-                    if len(msg.get('text', '')) > 300:
-                        result += "..."
-                    result += f"\n   🔗 لینک: https://t.me/{channel_username}/{msg_id}\n\n"
-                
-                # Add note about total results if there are more
-                if len(relevant_messages) > 15:
-                    result += f"📝 توجه: {len(relevant_messages) - 15} پیام مرتبط دیگر نیز یافت شد که برای خلاصگی نمایش داده نشد.\n\n"
-            else:
-                highest_score = message_scores[0][1] if message_scores else 0
-                result += f"❌ اطلاعات مرتبط یافت نشد (بالاترین امتیاز: {highest_score:.3f})\n\n"
-                # Show top 10 for debugging
-                for i, (msg, score) in enumerate(message_scores[:10], 1):
-                    text = msg.get('text', '')[:200]
-                    date = msg.get('date', 'نامشخص')
-                    msg_id = msg.get('id', 'نامشخص')
-                    channel_username = msg.get('channel', msg.get('channel_name', channel_username))
-                    
-                    result += f"{i}. امتیاز: {score:.3f} | تاریخ: {date}\n"
-                    result += f"   متن: {text}"
-                    if len(msg.get('text', '')) > 200:
-                        result += "..."
-                    result += f"\n   🔗 لینک: https://t.me/{channel_username}/{msg_id}\n\n"
+            # Weaker semantic hits are relevant only if they contain a query word (checked on the cached lowered text)
+            relevant_count += sum(
+                1 for similarity, position in zip(sims, hit_positions)
+                if similarity > 0.5 or any(word in texts_lower[position] for word in query_words)
+            )
             
-            return result
+            logger.debug("   ✅ %d نتیجه معنایی یافت شد", semantic_found)
+        
+        # Sort by similarity
+        message_scores.sort(key=lambda x: x[1], reverse=True)
+        
+        parts = [f"پیام‌های مرتبط در کانال {channel_username}:\n\n"]
+        
+        if relevant_count:
+            # Limit to top 15 most relevant messages to avoid overwhelming responses
+            top_messages = message_scores[:15]
+            parts.append(f"✅ اطلاعات مرتبط یافت شد! ({len(top_messages)} پیام از {relevant_count} پیام مرتبط)\n\n")
+            parts.extend(
+                self._format_message_hit(i, msg, score, channel_username, 300)  # Show more text
+                for i, (msg, score) in enumerate(top_messages, 1)
+            )
             
-        except Exception as e:
-            return f"خطا در جستجوی پیام‌ها: {e}"
+            # Add note about total results if there are more
+            if relevant_count > 15:
+                parts.append(f"📝 توجه: {relevant_count - 15} پیام مرتبط دیگر نیز یافت شد که برای خلاصگی نمایش داده نشد.\n\n")
+        else:
+            highest_score = message_scores[0][1] if message_scores else 0
+            parts.append(f"❌ اطلاعات مرتبط یافت نشد (بالاترین امتیاز: {highest_score:.3f})\n\n")
+            # Show top 10 for debugging
+            parts.extend(
+                self._format_message_hit(i, msg, score, channel_username, 200)
+                for i, (msg, score) in enumerate(message_scores[:10], 1)
+            )
+        
+        return ''.join(parts)
+    
+    @staticmethod
+    def _format_message_hit(i: int, msg: Dict[str, Any], score: float, channel_username: str, max_chars: int) -> str:
+        """One numbered search hit with its score, date, truncated text and link"""
+        full_text = msg.get('text', '')
+        text = full_text[:max_chars] + ("..." if len(full_text) > max_chars else "")
+        date = msg.get('date', 'نامشخص')
+        msg_id = msg.get('id', 'نامشخص')
+        channel_username = msg.get('channel', msg.get('channel_name', channel_username))
+        return (f"{i}. امتیاز: {score:.3f} | تاریخ: {date}\n"
+                f"   متن: {text}\n"
+                f"   🔗 لینک: https://t.me/{channel_username}/{msg_id}\n\n")
+        
+    
+    def search_messages_in_channels(self, channel_usernames: List[str], query: str) -> str:
+        """Search for messages in several channels with a single tool call, in parallel"""
+        channel_usernames = list(dict.fromkeys(channel_usernames))  # Drop duplicates, keep order
+        results = self._pool.map(lambda channel_username: self.search_messages_in_channel(channel_username, query), channel_usernames)
+        return "\n\n".join(results)
+    
+    def _pooled(self, func):
+        """Coroutine running a blocking tool function on the search pool, so the agent's parallel tool calls overlap"""
+        async def run(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, partial(func, *args, **kwargs))
+        return run
+    
+    async def asearch_messages_in_channels(self, channel_usernames: List[str], query: str) -> str:
+        """Async variant that searches all channels concurrently in the search pool"""
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(self._pool, self.search_messages_in_channel, channel_username, query)
+            for channel_username in dict.fromkeys(channel_usernames)
+        ])
+        return "\n\n".join(results)
     
     def get_channel_info(self, channel_username: str) -> str:
         """Get information about a specific channel"""
@@ -461,35 +1493,26 @@ class LangChainRAGSystem:
             # Priority channels that should be checked if not already included
             priority_channels = ['sharifdaily', 'sharif_senfi']
             
-            # Find more relevant channels
-            query_embedding = self.embedding_model.encode(query)
-            
-            channel_scores = []
             additional_channels = []
             
             # First, add priority channels if not already checked
             for priority_ch in priority_channels:
-                if priority_ch not in current_list and priority_ch in [ch['username'] for ch in self.active_channels]:
+                if priority_ch not in current_list and priority_ch in self._channel_rows:
                     additional_channels.append(priority_ch)
                     if len(additional_channels) >= 5:
                         return f"کانال‌های اضافی (5 تا): {', '.join(additional_channels)}"
             
-            # Then add semantic matches
-            for channel in self.active_channels:
-                if channel['username'] not in current_list and channel['username'] not in additional_channels:
-                    channel_text = f"{channel['name']} {channel['description']}"
-                    channel_embedding = self.embedding_model.encode(channel_text)
-                    similarity = self.cosine_similarity(query_embedding, channel_embedding)
-                    channel_scores.append((channel['username'], similarity))
-            
-            # Sort by similarity and add top matches
-            channel_scores.sort(key=lambda x: x[1], reverse=True)
+            # Then add semantic matches, reusing the precomputed channel matrix
+            keep = np.ones(len(self._channel_usernames), dtype=bool)
+            keep[[self._channel_rows[u] for u in current_list + additional_channels if u in self._channel_rows]] = False
+            candidates = np.flatnonzero(keep)
             
-            for username, score in channel_scores:
-                if len(additional_channels) < 5:
-                    additional_channels.append(username)
-                else:
-                    break
+            if len(candidates):
+                query_embedding = self._encode_query(query)
+                scores = self._channel_embeddings[candidates] @ query_embedding
+                
+                for i in candidates[self.top_k_indices(scores, 5 - len(additional_channels))]:
+                    additional_channels.append(self._channel_usernames[i])
             
             return f"کانال‌های اضافی (5 تا): {', '.join(additional_channels)}"
             
@@ -498,45 +1521,67 @@ class LangChainRAGSystem:
     
     def preprocess_text(self, text: str) -> str:
         """Preprocess text for better semantic search"""
-        import re
-        
         # Quick check for very short texts
         if len(text) < 10:
             return text
         
         # Remove URLs
-        text = re.sub(r'http[s]?://[^\s]+', '', text)
+        text = _URL_RE.sub('', text)
         
         # Remove emojis and special characters but keep Persian text
-        text = re.sub(r'[^\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFFa-zA-Z0-9\s]', ' ', text)
+        text = _NON_TEXT_RE.sub(' ', text)
         
         # Remove extra whitespace
-        text = re.sub(r'\s+', ' ', text).strip()
+        text = _WHITESPACE_RE.sub(' ', text).strip()
         
         # Only remove stop words for longer texts
         if len(text) > 50:
-            stop_words = ['و', 'در', 'به', 'از', 'که', 'این', 'آن', 'با', 'برای', 'تا', 'را', 'یا', 'اما', 'اگر', 'چون', 'چرا', 'چگونه', 'کجا', 'کی', 'چه', 'چند', 'هم', 'نیز', 'همچنین', 'همه', 'هیچ', 'هر']
-            words = text.split()
-            words = [word for word in words if word not in stop_words and len(word) > 1]
-            return ' '.join(words)
+            return ' '.join(word for word in text.split() if word not in _STOP_WORDS and len(word) > 1)
         
         return text
     
-    def cosine_similarity(self, vec1, vec2):
-        """Calculate cosine similarity between two vectors"""
-        import numpy as np
-        dot_product = np.dot(vec1, vec2)
-        norm1 = np.linalg.norm(vec1)
-        norm2 = np.linalg.norm(vec2)
-        return dot_product / (norm1 * norm2)
+    def preprocess_batch(self, texts: List[str]) -> List[str]:
+        """Preprocess many texts with the precompiled patterns"""
+        preprocess = self.preprocess_text
+        return [preprocess(text) for text in texts]
+    
+    @staticmethod
+    def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+        """Indices of the k highest scores, best first, without sorting the whole array"""
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.zeros(0, dtype=np.intp)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
     
     def load_database(self) -> Dict[str, Any]:
-        """Load the local database"""
+        """Load the local database, with channels read lazily from per-channel shards"""
         try:
-            with open(self.database_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                print(f"✅ Loaded database with {data['metadata']['total_channels']} channels and {data['metadata']['total_messages']} messages")
-                return data
+            stat = os.stat(self.database_file)
+            source_key = [os.path.abspath(self.database_file), stat.st_mtime_ns, stat.st_size]
+            shard_dir = os.path.join(self.cache_dir, 'db')
+            
+            # Reuse the shards if they were split from this exact file
+            try:
+                with open(os.path.join(shard_dir, 'metadata.json'), 'rb') as f:
+                    shard_info = _json_loads(f.read())
+                if shard_info.get('source') != source_key:
+                    shard_info = None
+            except (OSError, ValueError):
+                shard_info = None
+            
+            if shard_info is None:
+                with open(self.database_file, 'rb') as f:
+                    data = _json_loads(f.read())
+                shard_info = self._split_database(data, shard_dir, source_key)
+                if shard_info is None:
+                    # Shards could not be written - keep the whole database in memory
+                    print(f"✅ Loaded database with {data['metadata']['total_channels']} channels and {data['metadata']['total_messages']} messages")
+                    return data
+            
+            metadata = shard_info['metadata']
+            print(f"✅ Loaded database with {metadata['total_channels']} channels and {metadata['total_messages']} messages")
+            return {"metadata": metadata, "channels": LazyChannels(shard_dir, shard_info['channels'])}
         except FileNotFoundError:
             print(f"⚠️ Database file {self.database_file} not found!")
             return {"metadata": {"total_channels": 0, "total_messages": 0}, "channels": {}}
@@ -544,6 +1589,26 @@ class LangChainRAGSystem:
             print(f"❌ Error loading database: {e}")
             return {"metadata": {"total_channels": 0, "total_messages": 0}, "channels": {}}
     
+    def _split_database(self, data: Dict[str, Any], shard_dir: str, source_key: List[Any]) -> Optional[Dict[str, Any]]:
+        """Write one JSON file per channel plus a small metadata.json describing them"""
+        shard_info = {
+            "source": source_key,
+            "metadata": data['metadata'],
+            "channels": list(data['channels'].keys())
+        }
+        try:
+            os.makedirs(shard_dir, exist_ok=True)
+            for channel_username, channel_data in data['channels'].items():
+                with open(os.path.join(shard_dir, f"{channel_username}.json"), 'wb') as f:
+                    f.write(_json_dumps(channel_data))
+            # Written last so a partial split is never mistaken for a valid one
+            with open(os.path.join(shard_dir, 'metadata.json'), 'wb') as f:
+                f.write(_json_dumps(shard_info))
+        except OSError as e:
+            print(f"⚠️ Could not split database into channel files: {e}")
+            return None
+        return shard_info
+    
     def load_config(self, config_file: str = None) -> Dict[str, Any]:
         """Load configuration from JSON file"""
         if config_file is None:
@@ -566,23 +1631,262 @@ class LangChainRAGSystem:
             }
         }
     
-    def query(self, question: str) -> str:
-        """Main query function using LangChain agent"""
+    def query(self, question: str, bypass_cache: bool = False) -> str:
+        """Main query function using LangChain agent (blocking wrapper around aquery)"""
+        parts = []
+        for delta in self.stream(question, bypass_cache):
+            if delta is STREAM_RESET:
+                parts.clear()
+            else:
+                parts.append(delta)
+        return ''.join(parts)
+    
+    def stream(self, question: str, bypass_cache: bool = False) -> Iterator[str]:
+        """Blocking generator over the answer's text deltas, for printing them as they arrive"""
+        # One loop for all blocking calls, so the async HTTP client's pooled connections stay usable.
+        # Each step holds the lock only while the loop runs, so streams from several threads interleave
+        with self._query_lock:
+            if self._query_loop is None:
+                self._query_loop = asyncio.new_event_loop()
+            loop = self._query_loop
+        
+        deltas = self.aquery(question, bypass_cache)
         try:
+            while True:
+                with self._query_lock:
+                    try:
+                        delta = loop.run_until_complete(deltas.__anext__())
+                    except StopAsyncIteration:
+                        return
+                yield delta
+        finally:
+            with self._query_lock:
+                loop.run_until_complete(deltas.aclose())
+    
+    async def aclose(self):
+        """Close the LLM HTTP clients; await it on the loop that ran aquery"""
+        if self.http_async_client is not None:
+            await self.http_async_client.aclose()
+        if self.http_client is not None:
+            self.http_client.close()
+    
+    def close(self):
+        """Close the LLM HTTP clients and the event loop behind query()"""
+        with self._query_lock:
+            loop, self._query_loop = self._query_loop, None
+            if loop is None:
+                loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self.aclose())
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            finally:
+                loop.close()
+    
+    async def aquery(self, question: str, bypass_cache: bool = False,
+                     question_embedding: Optional[np.ndarray] = None) -> AsyncIterator[str]:
+        """Stream the agent's answer as text deltas (bypass_cache forces a fresh, re-cached answer)"""
+        try:
+            key = normalize_query(question)
+            if not bypass_cache:
+                # _store_answer runs on worker threads, so the LRU is only touched under the lock
+                with self._cache_lock:
+                    cached = self._answer_cache.get(key)
+                    if cached is not None:
+                        self._answer_cache.move_to_end(key)
+                if cached is not None:
+                    print("⚡ پاسخ از کش")
+                    yield cached
+                    return
+            
+            await asyncio.to_thread(self.ensure_initialized)
             if not self.agent:
-                return "❌ LangChain system not initialized. Please check dependencies."
+                yield "❌ LangChain system not initialized. Please check dependencies."
+                return
+            
+            # Paraphrases of an earlier question reuse its answer
+            if question_embedding is None:
+                question_embedding = await asyncio.to_thread(self._encode_query, key)
+            if not bypass_cache:
+                cached = self._semantic_cache.lookup(question_embedding)
+                if cached is not None:
+                    print("⚡ پاسخ از کش معنایی")
+                    # The exact cache answers this wording next time without embedding it
+                    await asyncio.to_thread(self._store_answer, key, cached)
+                    yield cached
+                    return
             
             print(f"🔍 جستجو برای: {question}")
             print("🤖 استفاده از LangChain Agent...")
             
-            # Run agent
-            result = self.agent.invoke({"input": question})
+            # Run agent, forwarding LLM tokens as they arrive. Text a turn streams before calling a tool
+            # is not part of the answer, so a tool call discards everything streamed until then
+            parts = []
+            async for event in self.agent.astream_events({"input": question}, version="v2"):
+                if event['event'] == 'on_tool_start':
+                    if parts:
+                        parts = []
+                        yield STREAM_RESET
+                    continue
+                if event['event'] != 'on_chat_model_stream':
+                    continue
+                delta = event['data']['chunk'].content
+                if isinstance(delta, str) and delta:
+                    parts.append(delta)
+                    yield delta
             
-            return result.get('output', 'پاسخ یافت نشد')
+            answer = ''.join(parts)
+            if not answer:
+                yield 'پاسخ یافت نشد'
+                return
             
-        except Exception as e:
+            # The stores commit to sqlite, so they run off the event loop
+            await asyncio.to_thread(self._store_answer, key, answer)
+            await asyncio.to_thread(self._store_semantic, key, question_embedding, answer)
+            
+        except _RETRYABLE as e:
             print(f"❌ Error in LangChain query: {e}")
-            return f"متأسفانه خطایی در پردازش سوال رخ داد: {e}"
+            yield f"متأسفانه خطایی در پردازش سوال رخ داد: {e}"
+
+# Interactive loop strings
+_EXIT_TOKENS = frozenset({'quit', 'exit', 'خروج'})
+_PROMPT = "❓ سوال خود را بپرسید (یا 'quit' برای خروج): "
+_SEP = "=" * 50
+# Answer banners are encoded once and written straight to stdout's byte buffer
+_ANS_HEADER = ("\n" + _SEP + "\n\n🤖 پاسخ:\n").encode('utf-8')
+_ANS_FOOTER = ("\n" + _SEP + "\n\n").encode('utf-8')
+_ERR_FMT = "❌ خطا: {}".format
+
+# Background work done while the user reads the answer and types the next question
+_PREFETCH = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rag-prefetch')
+
+
+def _enable_history(history_file: str):
+    """Arrow-key recall of earlier questions, kept across runs"""
+    try:
+        import readline
+    except ImportError:  # not available on Windows
+        return
+    try:
+        readline.read_history_file(history_file)
+    except OSError:
+        pass  # first run
+    readline.set_history_length(2000)
+    os.makedirs(os.path.dirname(history_file), exist_ok=True)
+    atexit.register(readline.write_history_file, history_file)
+
+
+def _write_bytes(data: bytes):
+    """Write pre-encoded UTF-8 output after anything already written as text"""
+    sys.stdout.flush()
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
+
+
+def _read_line(prompt: str) -> asyncio.Future:
+    """Show the prompt and read one stdin line on a daemon thread (the future gets None on EOF)"""
+    loop = asyncio.get_running_loop()
+    line = loop.create_future()
+    
+    def reader():
+        # input() gets line editing and history from readline when it is loaded
+        try:
+            text = input(prompt)
+        except EOFError:
+            text = None
+        try:
+            loop.call_soon_threadsafe(deliver, text)
+        except RuntimeError:
+            pass  # loop already closed
+    
+    def deliver(text: Optional[str]):
+        if not line.done():  # cancelled by Ctrl+C
+            line.set_result(text)
+    
+    # A daemon thread, not the default executor, so exiting never waits on a blocked read
+    threading.Thread(target=reader, name='stdin-reader', daemon=True).start()
+    return line
+
+
+async def _repl(rag: LangChainRAGSystem, prompt: str = _PROMPT, exit_tokens: frozenset = _EXIT_TOKENS):
+    """Interactive question/answer loop"""
+    while True:
+        # Idle time while the user types warms the search indexes
+        line = _read_line(prompt)
+        done, _ = await asyncio.wait({line}, timeout=0.5)
+        if not done:
+            await asyncio.to_thread(rag.warm_up)
+        query = await line
+        if query is None:
+            break
+        
+        try:
+            # Strip and lowercase once per line; already-lowercase ASCII needs no lower()
+            query = query.strip()
+            if not query:
+                continue
+            if (query if query.isascii() and query.islower() else query.lower()) in exit_tokens:
+                break
+            
+            # A leading "!" skips the answer cache and asks the agent again
+            bypass_cache = query.startswith('!')
+            if bypass_cache:
+                query = query[1:]
+            
+            if query:
+                _write_bytes(_ANS_HEADER)
+                # Print the answer as it is generated, on the same loop as the agent's HTTP client
+                parts = []
+                async for delta in rag.aquery(query, bypass_cache=bypass_cache):
+                    if delta is STREAM_RESET:
+                        # Printed preamble stays on screen; the answer starts on a fresh line
+                        parts.clear()
+                        sys.stdout.write('\n')
+                        continue
+                    parts.append(delta)
+                    sys.stdout.write(delta)
+                    sys.stdout.flush()
+                result = ''.join(parts)
+                _write_bytes(_ANS_FOOTER)
+                _PREFETCH.submit(rag.prefetch_related, result)
+                
+        except _RETRYABLE as e:
+            print(_ERR_FMT(e))
+
+
+async def _run_and_close(rag: LangChainRAGSystem, mode: Awaitable):
+    """Run a CLI mode, then close the HTTP clients on the loop their connections belong to"""
+    try:
+        return await mode
+    finally:
+        await rag.aclose()
+
+
+async def _run_batch(rag: LangChainRAGSystem, path: str):
+    """Answer every non-empty line of a file, embedding the distinct questions in one batch"""
+    with open(path, encoding='utf-8') as f:
+        questions = [line.strip() for line in f if line.strip()]
+    
+    # Repeated questions (after normalization) are answered once
+    distinct = {}
+    for question in questions:
+        distinct.setdefault(normalize_query(question), question)
+    embeddings = await asyncio.to_thread(rag.encode_queries, list(distinct))
+    
+    # Each answer is encoded once, however often its question repeats
+    answers = {}
+    for (key, question), embedding in zip(distinct.items(), embeddings):
+        parts = []
+        async for delta in rag.aquery(question, question_embedding=embedding):
+            if delta is STREAM_RESET:
+                parts.clear()
+            else:
+                parts.append(delta)
+        answer = ''.join(parts)
+        answers[key] = answer.encode('utf-8')
+    
+    for question in questions:
+        _write_bytes(b''.join((f"❓ {question}\n".encode('utf-8'), _ANS_HEADER, answers[normalize_query(question)], _ANS_FOOTER)))
+
 
 def main():
     """Main function"""
@@ -591,10 +1895,19 @@ def main():
     parser = argparse.ArgumentParser(description="LangChain RAG System")
     parser.add_argument("--daemon", action="store_true", help="Run as daemon")
     parser.add_argument("--query", type=str, help="Single query")
+    parser.add_argument("--batch", type=str, help="Answer each line of a file")
+    parser.add_argument("--build-index", action="store_true", help="Precompute message embeddings and exit")
+    parser.add_argument("--verbose", action="store_true", help="Show per-query search diagnostics")
     
     args = parser.parse_args()
     
+    logging.basicConfig(format='%(message)s', level=logging.DEBUG if args.verbose else logging.WARNING)
+    
+    # Flush each answer line as it is printed, also when stdout is a pipe
+    sys.stdout.reconfigure(line_buffering=True)
+    
     rag = LangChainRAGSystem()
+    rag.start_cache_sweeper()
     
     print("🤖 سیستم LangChain RAG آماده است!")
     print("💾 دیتابیس:", rag.database_file)
@@ -602,12 +1915,22 @@ def main():
     print("💬 تعداد پیام‌ها:", rag.database['metadata'].get('total_messages', 0))
     print()
     
+    if args.build_index:
+        rag.build_message_index()
+        print("✅ ایندکس پیام‌ها ساخته شد")
+        return
+    
     if args.query:
         # Single query
-        result = rag.query(args.query)
-        print("\n" + "="*60 + "\n")
-        print("🤖 پاسخ:")
-        print(result)
+        try:
+            result = rag.query(args.query)
+        finally:
+            rag.close()
+        sys.stdout.write(f"\n{'=' * 60}\n\n🤖 پاسخ:\n{result}\n")
+        return
+    
+    if args.batch:
+        asyncio.run(_run_and_close(rag, _run_batch(rag, args.batch)))
         return
     
     if args.daemon:
@@ -615,45 +1938,14 @@ def main():
         print("🚀 راه‌اندازی سیستم LangChain RAG...")
         print("🔄 برای خروج Ctrl+C را فشار دهید")
         print()
-        
-        while True:
-            try:
-                query = input("❓ سوال خود را بپرسید (یا 'quit' برای خروج): ")
-                if query.lower() in ['quit', 'exit', 'خروج']:
-                    break
-                
-                if query.strip():
-                    print("\n" + "="*50)
-                    result = rag.query(query)
-                    print("\n🤖 پاسخ:")
-                    print(result)
-                    print("="*50 + "\n")
-                    
-            except KeyboardInterrupt:
-                print("\n🛑 خروج از سیستم...")
-                break
-            except Exception as e:
-                print(f"❌ خطا: {e}")
     
-    # Default interactive mode
-    while True:
-        try:
-            query = input("❓ سوال خود را بپرسید (یا 'quit' برای خروج): ")
-            if query.lower() in ['quit', 'exit', 'خروج']:
-                break
-            
-            if query.strip():
-                print("\n" + "="*50)
-                result = rag.query(query)
-                print("\n🤖 پاسخ:")
-                print(result)
-                print("="*50 + "\n")
-                
-        except KeyboardInterrupt:
-            print("\n🛑 خروج از سیستم...")
-            break
-        except Exception as e:
-            print(f"❌ خطا: {e}")
+    if sys.stdin.isatty():
+        _enable_history(os.path.join(rag.cache_dir, 'history'))
+    
+    try:
+        asyncio.run(_run_and_close(rag, _repl(rag)))
+    except KeyboardInterrupt:
+        print("\n🛑 خروج از سیستم...")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
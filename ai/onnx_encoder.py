@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+ONNX Runtime sentence encoder
+Drop-in replacement for SentenceTransformer.encode using an exported (optionally int8 quantized) model
+
+One-time export:
+    optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 minilm-onnx/
+    optimum-cli onnxruntime quantize --avx512_vnni --onnx_model minilm-onnx/ -o minilm-onnx/
+"""
+
+import os
+from typing import List, Union
+import numpy as np
+
+
+class OnnxSentenceEncoder:
+    """Mean-pooled sentence embeddings from an ONNX transformer and its tokenizer.json"""
+
+    def __init__(self, model_dir: str, max_length: int = 128):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        # Prefer the int8 model written by `optimum-cli onnxruntime quantize`
+        model_path = os.path.join(model_dir, 'model_quantized.onnx')
+        if not os.path.exists(model_path):
+            model_path = os.path.join(model_dir, 'model.onnx')
+
+        self.session = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+
+        self._dimension = None
+
+    def get_sentence_embedding_dimension(self) -> int:
+        if self._dimension is None:
+            self._dimension = self.encode(['dimension probe']).shape[1]
+        return self._dimension
+
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 128, show_progress_bar: bool = False,
+               convert_to_numpy: bool = True, normalize_embeddings: bool = False) -> np.ndarray:
+        """Encode one sentence (returns a vector) or a list of sentences (returns a matrix)"""
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        # Batch similar lengths together so little of each batch is padding (as SentenceTransformer does)
+        order = np.argsort([-len(sentence) for sentence in sentences], kind='stable')
+        sorted_sentences = [sentences[i] for i in order]
+        
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            encodings = self.tokenizer.encode_batch(sorted_sentences[start:start + batch_size])
+            input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+
+            feeds = {'input_ids': input_ids, 'attention_mask': attention_mask}
+            if 'token_type_ids' in self.input_names:
+                feeds['token_type_ids'] = np.zeros_like(input_ids)
+            token_embeddings = self.session.run(None, feeds)[0]
+
+            # Mean pooling over real (non-padding) tokens
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            batches.append(pooled.astype(np.float32))
+
+        if batches:
+            embeddings = np.empty((len(sentences), batches[0].shape[1]), dtype=np.float32)
+            embeddings[order] = np.concatenate(batches)
+        else:
+            embeddings = np.zeros((0, self._dimension or 0), dtype=np.float32)
+
+        if normalize_embeddings and len(embeddings):
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = embeddings / np.maximum(norms, 1e-12)
+
+        return embeddings[0] if single else embeddings
@@ -6,16 +6,86 @@ Supports both directory structure and direct JSON files
 """
 
 import json
+import mmap
 import os
 import sys
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Tuple
 from datetime import datetime
 import logging
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson  # Optional, reads and writes large exports several times faster
+except ImportError:
+    orjson = None
+
+try:
+    import ijson  # Optional, streams the messages array so huge exports never sit fully in memory
+except ImportError:
+    ijson = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+def load_json_file(path: str) -> Any:
+    """Parse a JSON file, with orjson when it is installed"""
+    with open(path, 'rb') as f:
+        if orjson is None or os.fstat(f.fileno()).st_size == 0:
+            raw = f.read()
+            return orjson.loads(raw) if orjson is not None else json.loads(raw)
+        
+        # orjson reads the mapped page cache directly, without a second copy of the file in a bytes object
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            return orjson.loads(view)
+
+def _stream_export_name(path: str) -> Optional[str]:
+    """Top-level name of an export, scanning only the tokens before the messages array"""
+    with open(path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f):
+            if prefix == 'name' and event == 'string':
+                return value
+            if prefix == 'messages':
+                # Telegram Desktop writes name/type/id ahead of the messages
+                return None
+    return None
+
+def _stream_export_messages(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield the messages of an export one at a time"""
+    with open(path, 'rb') as f:
+        yield from ijson.items(f, 'messages.item', use_float=True)
+
+def read_export(path: str) -> Tuple[Optional[str], Iterable[Dict[str, Any]]]:
+    """Channel name and messages of a Telegram export, streamed with ijson when it is installed"""
+    if ijson is not None:
+        return _stream_export_name(path), _stream_export_messages(path)
+    data = load_json_file(path)
+    return data.get('name'), data.get('messages', [])
+
+class ExportMessage:
+    """A kept export message; slots keep millions of them far smaller than per-message dicts"""
+    __slots__ = ('id', 'text', 'date', 'sender', 'views')
+    
+    def __init__(self, id: str, text: str, date: str, sender: str, views: int):
+        self.id = id
+        self.text = text
+        self.date = date
+        self.sender = sender
+        self.views = views
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """The message in the channels database format"""
+        return {
+            "id": self.id,
+            "text": self.text,
+            "date": self.date,
+            "from": self.sender,
+            "views": self.views,
+            "type": "message"
+        }
+
 class TelegramExportParser:
     def __init__(self, export_dir: str = "telegram_export"):
         """
@@ -33,25 +103,34 @@ class TelegramExportParser:
                 logger.info("Please export your Telegram data from Telegram Desktop")
                 return {}
             
-            channels = {}
+            tasks = []
             
             # Look for JSON files directly in the directory
-            for item in os.listdir(self.export_dir):
-                item_path = os.path.join(self.export_dir, item)
-                
-                if item.endswith('.json') and os.path.isfile(item_path):
-                    # Direct JSON file
-                    channel_name = os.path.splitext(item)[0]
-                    channel_data = self.parse_json_file(channel_name, item_path)
-                    if channel_data:
-                        channels[channel_name] = channel_data
-                elif os.path.isdir(item_path):
-                    # Check if it's a channel directory (has messages.json)
-                    messages_file = os.path.join(item_path, "messages.json")
-                    if os.path.exists(messages_file):
-                        channel_data = self.parse_channel(item, item_path)
-                        if channel_data:
-                            channels[item] = channel_data
+            # (scandir entries carry their file type, so no stat per entry)
+            with os.scandir(self.export_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json') and entry.is_file():
+                        # Direct JSON file
+                        tasks.append(('json', os.path.splitext(entry.name)[0], entry.path))
+                    elif entry.is_dir():
+                        # Check if it's a channel directory (has messages.json)
+                        messages_file = os.path.join(entry.path, "messages.json")
+                        if os.path.exists(messages_file):
+                            tasks.append(('dir', entry.name, entry.path))
+            
+            # Channels are independent, so decode them on separate cores
+            workers = min(len(tasks), os.cpu_count() or 1)
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    results = list(executor.map(_parse_task, tasks))
+            else:
+                results = [_parse_task(task) for task in tasks]
+            
+            channels = {}
+            for (_, channel_name, _), channel_data in zip(tasks, results):
+                if channel_data:
+                    channel_data['messages'] = [message.to_dict() for message in channel_data['messages']]
+                    channels[channel_name] = channel_data
             
             return channels
             
@@ -59,42 +138,56 @@ class TelegramExportParser:
             logger.error(f"Error parsing export: {e}")
             return {}
     
-    def parse_channel(self, channel_name: str, channel_dir: str) -> Optional[Dict[str, Any]]:
+    @staticmethod
+    def _extract_messages(raw_messages: Iterable[Dict[str, Any]]) -> List[ExportMessage]:
+        """
+        Keep text messages longer than 5 characters, normalized to the database format
+        """
+        messages = []
+        append = messages.append
+        now_iso = datetime.now().isoformat()
+        
+        for msg in raw_messages:
+            get = msg.get
+            text = get('text')
+            if not text or get('type') != 'message':
+                continue
+            
+            # Handle different text formats
+            text_type = type(text)
+            if text_type is str:
+                text = text.strip()
+            elif text_type is list:
+                # Text is a list of text entities
+                text = ' '.join([item.get('text', '') for item in text if type(item) is dict])
+            else:
+                continue
+            
+            if len(text) > 5:  # Filter out very short messages
+                append(ExportMessage(
+                    str(get('id', 'unknown')),
+                    text,
+                    get('date') or now_iso,
+                    get('from', 'Channel'),
+                    get('views', 0)
+                ))
+        
+        return messages
+    
+    def parse_channel(self, channel_name: str, channel_dir: str, compact: bool = False) -> Optional[Dict[str, Any]]:
         """
-        Parse a single channel directory
+        Parse a single channel directory (messages stay ExportMessage objects when compact)
         """
         try:
             messages_file = os.path.join(channel_dir, "messages.json")
             
-            with open(messages_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            messages = []
-            
-            # Parse messages
-            for msg in data.get('messages', []):
-                if msg.get('type') == 'message' and msg.get('text'):
-                    # Handle different text formats
-                    text = msg['text']
-                    if isinstance(text, list):
-                        # Text is a list of text entities
-                        text = ' '.join([item.get('text', '') for item in text if isinstance(item, dict)])
-                    elif isinstance(text, str):
-                        text = text.strip()
-                    else:
-                        continue
-                    
-                    if text and len(text) > 5:  # Filter out very short messages
-                        messages.append({
-                            "id": str(msg.get('id', 'unknown')),
-                            "text": text,
-                            "date": msg.get('date', datetime.now().isoformat()),
-                            "from": msg.get('from', 'Channel'),
-                            "views": msg.get('views', 0),
-                            "type": "message"
-                        })
+            _, raw_messages = read_export(messages_file)
+            
+            messages = self._extract_messages(raw_messages)
             
             if messages:
+                if not compact:
+                    messages = [message.to_dict() for message in messages]
                 channel_data = {
                     "username": channel_name,
                     "name": channel_name,
@@ -115,43 +208,21 @@ class TelegramExportParser:
             logger.error(f"Error parsing channel {channel_name}: {e}")
             return None
     
-    def parse_json_file(self, channel_name: str, json_file_path: str) -> Optional[Dict[str, Any]]:
+    def parse_json_file(self, channel_name: str, json_file_path: str, compact: bool = False) -> Optional[Dict[str, Any]]:
         """
-        Parse a direct JSON file (Telegram export format)
+        Parse a direct JSON file (Telegram export format; messages stay ExportMessage objects when compact)
         """
         try:
-            with open(json_file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            messages = []
-            
-            # Parse messages
-            for msg in data.get('messages', []):
-                if msg.get('type') == 'message' and msg.get('text'):
-                    # Handle different text formats
-                    text = msg['text']
-                    if isinstance(text, list):
-                        # Text is a list of text entities
-                        text = ' '.join([item.get('text', '') for item in text if isinstance(item, dict)])
-                    elif isinstance(text, str):
-                        text = text.strip()
-                    else:
-                        continue
-                    
-                    if text and len(text) > 5:  # Filter out very short messages
-                        messages.append({
-                            "id": str(msg.get('id', 'unknown')),
-                            "text": text,
-                            "date": msg.get('date', datetime.now().isoformat()),
-                            "from": msg.get('from', 'Channel'),
-                            "views": msg.get('views', 0),
-                            "type": "message"
-                        })
+            export_name, raw_messages = read_export(json_file_path)
+            
+            messages = self._extract_messages(raw_messages)
             
             if messages:
+                if not compact:
+                    messages = [message.to_dict() for message in messages]
                 channel_data = {
                     "username": channel_name,
-                    "name": data.get('name', channel_name),
+                    "name": export_name if export_name is not None else channel_name,
                     "description": "",
                     "exported_at": datetime.now().isoformat(),
                     "total_messages": len(messages),
@@ -184,8 +255,12 @@ class TelegramExportParser:
                 "channels": channels
             }
             
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            if orjson is not None:
+                with open(output_file, 'wb') as f:
+                    f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            else:
+                with open(output_file, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
             
             logger.info(f"Parsed data saved to {output_file}")
             return data
@@ -194,6 +269,15 @@ class TelegramExportParser:
             logger.error(f"Error saving parsed data: {e}")
             return None
 
+def _parse_task(task: Tuple[str, str, str]) -> Optional[Dict[str, Any]]:
+    """Parse one export file or channel directory (runs in a worker process)"""
+    kind, channel_name, path = task
+    parser = TelegramExportParser()
+    # Slotted messages pickle back to the parent far smaller than dicts
+    if kind == 'json':
+        return parser.parse_json_file(channel_name, path, compact=True)
+    return parser.parse_channel(channel_name, path, compact=True)
+
 def main():
     """Main function"""
     import argparse
@@ -27,6 +27,11 @@ class Config:
     MAX_MESSAGE_LENGTH = 4096
     MAX_MESSAGES_PER_10_MINUTES = 5  # Limit messages per user per 10 minutes per role
     
+    # Update handling - concurrent updates (one at a time per user) and outgoing HTTP connections
+    CONCURRENT_UPDATES = 32
+    CONNECTION_POOL_SIZE = 64  # Keep above CONCURRENT_UPDATES so every in-flight update can send
+    POOL_TIMEOUT = 20.0
+    
     # Channel Configuration
     CHANNEL_ID = int(os.getenv('CHANNEL_ID'))
     
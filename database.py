@@ -1,16 +1,52 @@
 import sqlite3
 import os
+import hashlib
+import queue
+import atexit
+import logging
+import threading
+import time
 from datetime import datetime
 from typing import Optional, List, Dict, Any
 
+logger = logging.getLogger(__name__)
+
 class Database:
     def __init__(self, db_path: str = "./bot_database.db"):
         self.db_path = db_path
+        self._local = threading.local()
+        
+        # Roles only change in update_roles_from_env, so reads are served from memory
+        self._roles_lock = threading.Lock()
+        self._roles_cache: Optional[List[Dict[str, Any]]] = None
+        self._role_by_id: Optional[Dict[int, Dict[str, Any]]] = None
+        
         self.init_database()
+        
+        # add_message only enqueues; a single writer thread batches the inserts
+        self._write_q = queue.Queue()
+        self.failed_writes = 0  # Queued items that could not be written even one at a time
+        threading.Thread(target=self._message_writer, daemon=True).start()
+        atexit.register(self.flush)
+    
+    def _conn(self) -> sqlite3.Connection:
+        """Long-lived connection for the calling thread, opened on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Statements are compiled once per connection and reused from its cache
+            conn = sqlite3.connect(self.db_path, cached_statements=256)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            conn.execute('PRAGMA cache_size=-65536')
+            conn.execute('PRAGMA mmap_size=268435456')
+            conn.execute('PRAGMA wal_autocheckpoint=1000')
+            self._local.conn = conn
+        return conn
     
     def init_database(self):
         """Initialize database with required tables"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._conn()
         cursor = conn.cursor()
         
         # Users table
@@ -85,21 +121,109 @@ class Database:
             )
         ''')
         
+        # Unread admin-message counter per user, kept current by triggers on messages
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'unread_counts'")
+        backfill_unread = cursor.fetchone() is None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS unread_counts (
+                user_id INTEGER PRIMARY KEY,
+                n INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        if backfill_unread:
+            cursor.execute('''
+                INSERT INTO unread_counts (user_id, n)
+                SELECT t.user_id, COUNT(*) FROM messages m
+                JOIN threads t ON m.thread_id = t.thread_id
+                WHERE m.sender_type = 'admin' AND m.is_read = 0
+                GROUP BY t.user_id
+            ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_unread_insert AFTER INSERT ON messages
+            WHEN NEW.sender_type = 'admin' AND NEW.is_read = 0
+            BEGIN
+                INSERT INTO unread_counts (user_id, n)
+                SELECT user_id, 1 FROM threads WHERE thread_id = NEW.thread_id
+                ON CONFLICT(user_id) DO UPDATE SET n = n + 1;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_unread_update AFTER UPDATE OF is_read ON messages
+            WHEN NEW.sender_type = 'admin' AND NEW.is_read != OLD.is_read
+            BEGIN
+                UPDATE unread_counts SET n = n + (CASE WHEN NEW.is_read THEN -1 ELSE 1 END)
+                WHERE user_id = (SELECT user_id FROM threads WHERE thread_id = NEW.thread_id);
+            END
+        ''')
+        
+        # Small key/value table for bookkeeping such as the roles config hash
+        cursor.execute('CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)')
+        
+        # One thread per user per role, also the index for the per-user thread lookup
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_threads_user_role_uniq'")
+        if cursor.fetchone() is None:
+            self._merge_duplicate_threads(conn)
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_threads_user_role_uniq ON threads(user_id, role_id)')
+        cursor.execute('DROP INDEX IF EXISTS idx_threads_user_role_last')
+        
+        # Indexes for unread counts and reply mappings
+        # (blocks is already covered by its UNIQUE(admin_user_id, blocked_user_id) index)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_thread_unread ON messages(thread_id, sender_type, is_read)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_mappings_thread ON message_mappings(thread_id)')
+        cursor.execute('PRAGMA optimize')
+        
         # Always update roles from environment variables
         self.update_roles_from_env()
         
         conn.commit()
-        conn.close()
+    
+    def _merge_duplicate_threads(self, conn: sqlite3.Connection):
+        """Migration: fold duplicate (user_id, role_id) threads into one before the unique index exists"""
+        # Databases from before the unique index created threads with a SELECT then INSERT, so a pair
+        # can have several threads. Keep the most recently active one (the thread get_active_thread
+        # returned), move the others' messages and reply mappings onto it and delete them, then create
+        # the index, all in one transaction so a failure leaves the database as it was.
+        conn.commit()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('CREATE TEMP TABLE thread_merge (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)')
+            cursor.execute('''
+                INSERT INTO thread_merge (old_id, new_id)
+                SELECT thread_id, keep_id FROM (
+                    SELECT thread_id, FIRST_VALUE(thread_id) OVER (
+                        PARTITION BY user_id, role_id
+                        ORDER BY last_activity DESC, thread_id DESC
+                    ) AS keep_id
+                    FROM threads
+                )
+                WHERE thread_id != keep_id
+            ''')
+            merged = cursor.rowcount
+            if merged:
+                cursor.execute('''
+                    UPDATE messages SET thread_id = (SELECT new_id FROM thread_merge WHERE old_id = messages.thread_id)
+                    WHERE thread_id IN (SELECT old_id FROM thread_merge)
+                ''')
+                cursor.execute('''
+                    UPDATE message_mappings SET thread_id = (SELECT new_id FROM thread_merge WHERE old_id = message_mappings.thread_id)
+                    WHERE thread_id IN (SELECT old_id FROM thread_merge)
+                ''')
+                cursor.execute('DELETE FROM threads WHERE thread_id IN (SELECT old_id FROM thread_merge)')
+                logger.warning(f"Merged {merged} duplicate threads before adding the unique (user_id, role_id) index")
+            cursor.execute('DROP TABLE thread_merge')
+            cursor.execute('CREATE UNIQUE INDEX idx_threads_user_role_uniq ON threads(user_id, role_id)')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            cursor.execute('DROP TABLE IF EXISTS temp.thread_merge')
+            raise
     
     def update_roles_from_env(self):
         """Update roles table from environment variables"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._conn()
         cursor = conn.cursor()
         
-        # Clear existing roles and reset autoincrement
-        cursor.execute('DELETE FROM roles')
-        cursor.execute('DELETE FROM sqlite_sequence WHERE name = "roles"')
-        
         # Insert roles from environment variables
         from config import Config
         
@@ -111,74 +235,92 @@ class Database:
             ('مسئول نشریه', 'ROLE_PUBLICATION_USER_ID', ''),
         ]
         
+        roles = []
         for role_name, user_id_key, description in role_configs:
             actual_user_id = Config.get_role_user_id(user_id_key)
-            if actual_user_id:  # Only insert if user ID is configured
-                cursor.execute('''
-                    INSERT INTO roles (role_name, user_id, description)
-                    VALUES (?, ?, ?)
-                ''', (role_name, actual_user_id, description))
+            # Only insert if user ID is configured (not empty or a placeholder value)
+            if actual_user_id and not actual_user_id.startswith('ROLE_') and not actual_user_id.endswith('_USER_ID'):
+                roles.append((role_name, actual_user_id, description))
+        
+        # Skip the rewrite when the configured roles are the same as last time
+        roles_hash = hashlib.sha1(repr(roles).encode('utf-8')).hexdigest()
+        cursor.execute("SELECT v FROM meta WHERE k = 'roles_hash'")
+        row = cursor.fetchone()
+        if row and row[0] == roles_hash:
+            return
+        
+        # Clear existing roles and reset autoincrement
+        cursor.execute('DELETE FROM roles')
+        cursor.execute('DELETE FROM sqlite_sequence WHERE name = "roles"')
+        
+        cursor.executemany('''
+            INSERT INTO roles (role_name, user_id, description)
+            VALUES (?, ?, ?)
+        ''', roles)
+        cursor.execute("INSERT OR REPLACE INTO meta (k, v) VALUES ('roles_hash', ?)", (roles_hash,))
         
         conn.commit()
-        conn.close()
+        
+        with self._roles_lock:
+            self._roles_cache = None
+            self._role_by_id = None
     
     def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
         """Add or update user information"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._conn()
         cursor = conn.cursor()
         
         cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, username, first_name, last_name)
+            INSERT INTO users (user_id, username, first_name, last_name)
             VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE
+            SET username = excluded.username, first_name = excluded.first_name, last_name = excluded.last_name
         ''', (user_id, username, first_name, last_name))
         
         conn.commit()
-        conn.close()
     
-    def get_roles(self) -> List[Dict[str, Any]]:
-        """Get all available roles with valid user IDs"""
-        conn = sqlite3.connect(self.db_path)
+    def _load_roles(self):
+        """Read the roles table into the in-memory caches"""
+        conn = self._conn()
         cursor = conn.cursor()
         
         cursor.execute('SELECT role_id, role_name, user_id, description FROM roles ORDER BY role_id')
         roles = []
+        role_by_id = {}
         for row in cursor.fetchall():
             role_id, role_name, user_id, description = row
+            role = {
+                'role_id': role_id,
+                'role_name': role_name,
+                'user_id': user_id,  # Changed from group_id
+                'description': description
+            }
+            role_by_id[role_id] = role
             
-            # Only include roles that have actual user IDs (not placeholder values)
-            if user_id and not user_id.startswith('ROLE_') and not user_id.endswith('_USER_ID'):
-                roles.append({
-                    'role_id': role_id,
-                    'role_name': role_name,
-                    'user_id': user_id,
-                    'description': description
-                })
-        
-        conn.close()
-        return roles
+            # Placeholder user IDs are never inserted, so every row is a valid role
+            roles.append(role)
+        
+        self._roles_cache = roles
+        self._role_by_id = role_by_id
+    
+    def get_roles(self) -> List[Dict[str, Any]]:
+        """Get all available roles with valid user IDs"""
+        with self._roles_lock:
+            if self._roles_cache is None:
+                self._load_roles()
+            return self._roles_cache
     
     def get_role_by_id(self, role_id: int) -> Optional[Dict[str, Any]]:
         """Get role by ID"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT role_id, role_name, user_id, description FROM roles WHERE role_id = ?', (role_id,))
-        row = cursor.fetchone()
-        
-        conn.close()
-        
-        if row:
-            return {
-                'role_id': row[0],
-                'role_name': row[1],
-                'user_id': row[2],  # Changed from group_id
-                'description': row[3]
-            }
-        return None
+        with self._roles_lock:
+            if self._role_by_id is None:
+                self._load_roles()
+            return self._role_by_id.get(role_id)
     
     def get_active_thread(self, user_id: int, role_id: int) -> Optional[int]:
         """Get thread for user and role - only one thread per user per role"""
-        conn = sqlite3.connect(self.db_path)
+        self.flush()
+        conn = self._conn()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -188,66 +330,126 @@ class Database:
         ''', (user_id, role_id))
         
         result = cursor.fetchone()
-        conn.close()
         
         return result[0] if result else None
     
     def create_thread(self, user_id: int, role_id: int) -> int:
         """Create a new thread for user and role - only one thread per user per role"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._conn()
         cursor = conn.cursor()
         
-        # Check if there's already a thread for this user and role
+        # Reactivate the existing thread for this user and role, or create it
         cursor.execute('''
-            SELECT thread_id FROM threads 
-            WHERE user_id = ? AND role_id = ?
+            INSERT INTO threads (user_id, role_id)
+            VALUES (?, ?)
+            ON CONFLICT(user_id, role_id) DO UPDATE
+            SET is_active = 1, last_activity = CURRENT_TIMESTAMP
         ''', (user_id, role_id))
         
-        existing_thread = cursor.fetchone()
-        
-        if existing_thread:
-            # Update existing thread to active and update last activity
-            thread_id = existing_thread[0]
-            cursor.execute('''
-                UPDATE threads 
-                SET is_active = 1, last_activity = CURRENT_TIMESTAMP
-                WHERE thread_id = ?
-            ''', (thread_id,))
-        else:
-            # Create new thread
-            cursor.execute('''
-                INSERT INTO threads (user_id, role_id)
-                VALUES (?, ?)
-            ''', (user_id, role_id))
-        thread_id = cursor.lastrowid
+        # Read the id back in the same transaction (RETURNING needs SQLite 3.35)
+        cursor.execute('SELECT thread_id FROM threads WHERE user_id = ? AND role_id = ?', (user_id, role_id))
+        thread_id = cursor.fetchone()[0]
         
         conn.commit()
-        conn.close()
         
         return thread_id
     
     def add_message(self, thread_id: int, telegram_message_id: int, sender_type: str, message_text: str):
-        """Add a message to a thread"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO messages (thread_id, telegram_message_id, sender_type, message_text)
-            VALUES (?, ?, ?, ?)
-        ''', (thread_id, telegram_message_id, sender_type, message_text))
-        
-        # Update thread last activity
-        cursor.execute('''
-            UPDATE threads SET last_activity = CURRENT_TIMESTAMP
-            WHERE thread_id = ?
-        ''', (thread_id,))
-        
-        conn.commit()
-        conn.close()
+        """Queue a message for the writer thread, which commits it to the thread shortly"""
+        self._write_q.put((('messages', (thread_id, telegram_message_id, sender_type, message_text)),))
+    
+    def add_message_mapping(self, telegram_message_id: int, thread_id: int):
+        """Queue a reply-tracking mapping; it is committed together with queued messages"""
+        self._write_q.put((('message_mappings', (telegram_message_id, thread_id)),))
+    
+    def add_messages(self, messages: List[tuple], mappings: List[tuple] = ()):
+        """Queue (thread_id, telegram_message_id, sender_type, message_text) rows and
+        (telegram_message_id, thread_id) mappings as one item, always committed together"""
+        self._write_q.put(tuple([('messages', row) for row in messages] +
+                                [('message_mappings', row) for row in mappings]))
+    
+    def flush(self):
+        """Block until every queued message and mapping has been committed"""
+        self._write_q.join()
+    
+    def _message_writer(self):
+        """Commit queued writes in batches of up to 64, lingering at most 5 ms for more"""
+        write_q = self._write_q
+        while True:
+            items = [write_q.get()]
+            try:
+                while len(items) < 64:
+                    items.append(write_q.get(timeout=0.005))
+            except queue.Empty:
+                pass
+            
+            # Nothing may escape this loop: a dead writer would leave every flush() waiting forever
+            try:
+                self._write_rows(items)
+            except Exception as e:
+                # One bad item must not take the rest of the batch with it
+                logger.warning(f"Batch of {len(items)} queued writes failed ({e}), retrying one at a time")
+                for item in items:
+                    self._write_item_with_retry(item)
+            finally:
+                for _ in items:
+                    write_q.task_done()
+    
+    def _write_item_with_retry(self, item):
+        """Write one queued item, retrying transient errors; count and log it if it still fails"""
+        error = None
+        for attempt in range(3):
+            try:
+                self._write_rows([item])
+                return
+            except sqlite3.OperationalError as e:
+                # Locked or busy database, I/O errors: worth another try
+                error = e
+                time.sleep(0.05 * 2 ** attempt)
+            except Exception as e:
+                error = e
+                break
+        self.failed_writes += 1
+        logger.error(f"Dropped queued writes {item!r}: {error}")
+    
+    def _write_rows(self, items):
+        """Write queued items, each a tuple of ('messages' | 'message_mappings', row), in one transaction"""
+        writes = [write for item in items for write in item]
+        messages = [row for table, row in writes if table == 'messages']
+        mappings = [row for table, row in writes if table == 'message_mappings']
+        
+        conn = self._conn()
+        try:
+            # Take the write lock up front so every queued write shares one commit
+            conn.execute('BEGIN IMMEDIATE')
+            if messages:
+                conn.executemany('''
+                    INSERT INTO messages (thread_id, telegram_message_id, sender_type, message_text)
+                    VALUES (?, ?, ?, ?)
+                ''', messages)
+                
+                # Update thread last activity
+                conn.executemany('''
+                    UPDATE threads SET last_activity = CURRENT_TIMESTAMP
+                    WHERE thread_id = ?
+                ''', [(thread_id,) for thread_id in {row[0] for row in messages}])
+            
+            if mappings:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO message_mappings (telegram_message_id, thread_id)
+                    VALUES (?, ?)
+                ''', mappings)
+            
+            conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
     
     def get_thread_messages(self, thread_id: int) -> List[Dict[str, Any]]:
         """Get all messages in a thread"""
-        conn = sqlite3.connect(self.db_path)
+        self.flush()
+        conn = self._conn()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -268,12 +470,12 @@ class Database:
                 'is_read': bool(row[5])
             })
         
-        conn.close()
         return messages
     
     def get_user_threads(self, user_id: int) -> List[Dict[str, Any]]:
         """Get all threads for a user"""
-        conn = sqlite3.connect(self.db_path)
+        self.flush()
+        conn = self._conn()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -295,12 +497,12 @@ class Database:
                 'is_active': bool(row[5])
             })
         
-        conn.close()
         return threads
     
     def mark_messages_as_read(self, thread_id: int, sender_type: str = 'admin'):
         """Mark messages as read for a specific sender type in a thread"""
-        conn = sqlite3.connect(self.db_path)
+        self.flush()
+        conn = self._conn()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -309,27 +511,21 @@ class Database:
         ''', (thread_id, sender_type))
         
         conn.commit()
-        conn.close()
     
     def get_unread_messages_count(self, user_id: int) -> int:
         """Get count of unread messages for a user"""
-        conn = sqlite3.connect(self.db_path)
+        self.flush()
+        conn = self._conn()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT COUNT(*) FROM messages m
-            JOIN threads t ON m.thread_id = t.thread_id
-            WHERE t.user_id = ? AND m.sender_type = 'admin' AND m.is_read = 0
-        ''', (user_id,))
-        
-        count = cursor.fetchone()[0]
-        conn.close()
+        cursor.execute('SELECT n FROM unread_counts WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
         
-        return count
+        return row[0] if row else 0
     
     def block_user(self, admin_user_id: int, blocked_user_id: int, reason: str = None):
         """Block a user by an admin"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._conn()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -338,11 +534,10 @@ class Database:
         ''', (admin_user_id, blocked_user_id, reason))
         
         conn.commit()
-        conn.close()
     
     def unblock_user(self, admin_user_id: int, blocked_user_id: int):
         """Unblock a user by an admin"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._conn()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -351,11 +546,10 @@ class Database:
         ''', (admin_user_id, blocked_user_id))
         
         conn.commit()
-        conn.close()
     
     def is_user_blocked(self, admin_user_id: int, user_id: int) -> bool:
         """Check if a user is blocked by an admin"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._conn()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -364,13 +558,12 @@ class Database:
         ''', (admin_user_id, user_id))
         
         count = cursor.fetchone()[0]
-        conn.close()
         
         return count > 0
     
     def get_blocked_users(self, admin_user_id: int) -> List[Dict[str, Any]]:
         """Get list of users blocked by an admin"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._conn()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -388,12 +581,12 @@ class Database:
                 'reason': row[2]
             })
         
-        conn.close()
         return blocked_users
     
     def get_thread_info(self, thread_id: int) -> Optional[Dict[str, Any]]:
         """Get thread information by thread_id"""
-        conn = sqlite3.connect(self.db_path)
+        self.flush()
+        conn = self._conn()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -405,7 +598,6 @@ class Database:
         ''', (thread_id,))
         
         row = cursor.fetchone()
-        conn.close()
         
         if row:
             return {
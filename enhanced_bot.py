@@ -2,15 +2,19 @@ import logging
 import os
 import sqlite3
 import fcntl
+import html
 import sys
+import time
 import asyncio
+import weakref
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Set, Awaitable
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, filters, ConversationHandler
+    ContextTypes, filters, ConversationHandler, BaseUpdateProcessor
 )
 from telegram.constants import ParseMode
 
@@ -27,13 +31,62 @@ logger = logging.getLogger(__name__)
 # Conversation states
 CHOOSING_ROLE, WAITING_FOR_MESSAGE, AI_CHAT = range(3)
 
+# Minimum seconds between edits of a streamed AI answer (Telegram rate-limits edits)
+STREAM_EDIT_INTERVAL = 0.4
+
+# Static keyboards, built once and shared by every render
+BACK_TO_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🏠 منوی اصلی", callback_data="back_to_menu")]])
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_menu")]])
+SEND_OR_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 ارسال پیام", callback_data="send_message")],
+    [InlineKeyboardButton("🏠 منوی اصلی", callback_data="back_to_menu")]
+])
+MESSAGE_SENT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 ارسال پیام دیگر", callback_data="send_message")],
+    [InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_role")],
+    [InlineKeyboardButton("🏠 منوی اصلی", callback_data="back_to_menu")]
+])
+TYPING_REPLY_MARKUP = ReplyKeyboardMarkup(
+    [[KeyboardButton("🔙 بازگشت")], [KeyboardButton("🏠 منوی اصلی")]],
+    resize_keyboard=True, one_time_keyboard=False
+)
+
+# Message-to-thread mappings kept in memory; older ones are read back from the database
+MESSAGE_MAP_CACHE_SIZE = 4096
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently across users but in order for each user, so conversation state never races"""
+    
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+        
+        # The lock lives as long as some update of this user holds or waits for it
+        lock = self._user_locks.get(user.id)
+        if lock is None:
+            lock = self._user_locks[user.id] = asyncio.Lock()
+        async with lock:
+            await coroutine
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
 class EnhancedCouncilBot:
     def __init__(self):
         self.db = Database(Config.DATABASE_PATH)
         self.user_states: Dict[int, Dict[str, Any]] = {}
-        self.message_thread_map: Dict[int, int] = {}  # Maps telegram message_id to thread_id
-        self.user_message_counts: Dict[int, Dict[str, int]] = {}  # Rate limiting: user_id -> {date -> count}
-        self.user_last_message: Dict[int, datetime] = {}  # Rate limiting: user_id -> last_message_time
+        self.message_thread_map: OrderedDict = OrderedDict()  # LRU of telegram message_id -> thread_id, misses fall back to the database
+        self.user_recent_messages: Dict[int, deque] = {}  # Rate limiting: user_id -> monotonic times of recent messages
+        self._rate_limit_swept = time.monotonic()
         
         # Lock file for preventing multiple instances
         self.lock_file_path = "bot.lock"
@@ -42,6 +95,39 @@ class EnhancedCouncilBot:
         # Channel ID for logging all messages
         self.CHANNEL_ID = Config.CHANNEL_ID  # Get from config
         
+        # Admin IDs are fixed by the config, so is_admin_user is a single set lookup
+        self._admin_ids = frozenset(filter(None, [
+            Config.ROLE_USERS['ROLE_SECRETARY_USER_ID'],
+            Config.ROLE_USERS['ROLE_LEGAL_USER_ID'],
+            Config.ROLE_USERS['ROLE_EDUCATIONAL_1_USER_ID'],
+            Config.ROLE_USERS['ROLE_EDUCATIONAL_2_USER_ID'],
+            Config.ROLE_USERS['ROLE_PUBLICATION_USER_ID'],
+            Config.ADMIN_USER_ID
+        ]))
+        
+        # Blocked user IDs per admin, loaded on first check and kept in step with block/unblock
+        self._blocks: Dict[int, Set[int]] = {}
+        
+        # Role and fixed rows of the main menu, built on first render
+        self._menu_rows: Optional[List[List[InlineKeyboardButton]]] = None
+        
+        # Inline keyboard callbacks: exact callback_data, then the prefix of prefix_... data
+        self._cb_exact = {
+            "get_user_id": self._cb_get_user_id,
+            "help": self._cb_help,
+            "ai_chat": self._cb_ai_chat,
+            "back_to_menu": self._cb_back_to_menu,
+            "blocks_main_menu": self._cb_blocks_main_menu,
+            "send_message": self._cb_send_message,
+            "back_to_role": self._cb_back_to_role,
+        }
+        self._cb_prefix = {
+            "block": self._cb_block,
+            "unblock": self._cb_unblock,
+            "blocks": self._cb_blocks,
+            "role": self._cb_role,
+        }
+        
         # AI System - will be initialized lazily
         self.ai_system = None
         self.ai_system_lock = asyncio.Lock()  # For thread safety
@@ -83,6 +169,8 @@ class EnhancedCouncilBot:
                             database_file=database_file,
                             config_file=config_file
                         )
+                        # Keep the answer caches from growing for the life of the bot
+                        self.ai_system.start_cache_sweeper()
                         
                         logger.info("AI system initialized successfully")
                     except ImportError as e:
@@ -99,6 +187,11 @@ class EnhancedCouncilBot:
         
         return self.ai_system
     
+    async def close_ai_system(self, application: Application):
+        """Close the AI system's HTTP clients on the loop that used them"""
+        if self.ai_system is not None:
+            await self.ai_system.aclose()
+    
     async def send_to_channel(self, context: ContextTypes.DEFAULT_TYPE, message: str, parse_mode: str = 'HTML'):
         """Send message to the logging channel"""
         try:
@@ -114,19 +207,20 @@ class EnhancedCouncilBot:
     def acquire_lock(self) -> bool:
         """Try to acquire a lock to prevent multiple instances"""
         try:
-            self.lock_file = open(self.lock_file_path, 'w')
+            # Append mode so a failed attempt leaves the running instance's info intact
+            self.lock_file = open(self.lock_file_path, 'a')
             fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
             
             # Write current process info to lock file
-            import psutil
-            current_process = psutil.Process()
-            lock_info = f"PID: {current_process.pid}\n"
+            pid = os.getpid()
+            lock_info = f"PID: {pid}\n"
             lock_info += f"Command: {' '.join(sys.argv)}\n"
             lock_info += f"Started: {datetime.now().isoformat()}\n"
+            self.lock_file.truncate(0)
             self.lock_file.write(lock_info)
             self.lock_file.flush()
             
-            logger.info(f"Lock acquired successfully. PID: {current_process.pid}")
+            logger.info(f"Lock acquired successfully. PID: {pid}")
             return True
         except (IOError, OSError) as e:
             logger.error(f"Failed to acquire lock: {e}")
@@ -152,8 +246,9 @@ class EnhancedCouncilBot:
         """Handle /start command"""
         user = update.effective_user
         
-        # Add user to database
-        self.db.add_user(
+        # Add user to database (writes run off the event loop so a busy database never stalls updates)
+        await asyncio.to_thread(
+            self.db.add_user,
             user_id=user.id,
             username=user.username,
             first_name=user.first_name,
@@ -164,21 +259,30 @@ class EnhancedCouncilBot:
         await self.show_role_menu(update, context)
         return CHOOSING_ROLE
     
+    def get_menu_rows(self) -> List[List[InlineKeyboardButton]]:
+        """Role buttons plus the fixed menu buttons, built once since roles only change on restart"""
+        if self._menu_rows is None:
+            rows = []
+            for role in self.db.get_roles():
+                rows.append([InlineKeyboardButton(
+                    role['role_name'], 
+                    callback_data=f"role_{role['role_id']}"
+                )])
+            
+            rows.append([InlineKeyboardButton("👥 گروه شورای صنفی", url="https://t.me/shora_sharif")])
+            rows.append([InlineKeyboardButton("🤖 چت با هوش مصنوعی", callback_data="ai_chat")])
+            rows.append([InlineKeyboardButton("🆔 شناسه من", callback_data="get_user_id")])
+            rows.append([InlineKeyboardButton("❓ راهنما", callback_data="help")])
+            self._menu_rows = rows
+        return self._menu_rows
+    
+    def invalidate_roles_cache(self):
+        """Rebuild the menu on its next render (call after changing the roles table)"""
+        self._menu_rows = None
+    
     async def show_role_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show the role selection menu"""
-        roles = self.db.get_roles()
-        
-        keyboard = []
-        for role in roles:
-            keyboard.append([InlineKeyboardButton(
-                role['role_name'], 
-                callback_data=f"role_{role['role_id']}"
-            )])
-        
-        keyboard.append([InlineKeyboardButton("👥 گروه شورای صنفی", url="https://t.me/shora_sharif")])
-        keyboard.append([InlineKeyboardButton("🤖 چت با هوش مصنوعی", callback_data="ai_chat")])
-        keyboard.append([InlineKeyboardButton("🆔 شناسه من", callback_data="get_user_id")])
-        keyboard.append([InlineKeyboardButton("❓ راهنما", callback_data="help")])
+        keyboard = list(self.get_menu_rows())
         
         # Add block list button only for admins and role users
         if self.is_admin_user(update.effective_user.id):
@@ -221,281 +325,312 @@ class EnhancedCouncilBot:
         query = update.callback_query
         await query.answer()
         
-        if query.data == "get_user_id":
-            await self.get_user_id(update, context)
+        # Whole-word buttons first (blocks_main_menu must not fall into the blocks_ prefix),
+        # then the id-carrying prefix_... buttons by their prefix
+        data = query.data
+        handler = self._cb_exact.get(data)
+        if handler is None:
+            prefix, sep, _ = data.partition("_")
+            if sep:
+                handler = self._cb_prefix.get(prefix)
+        if handler is not None:
+            return await handler(update, context, query)
+    
+    async def _cb_get_user_id(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+        """Show the user their Telegram ID"""
+        await self.get_user_id(update, context)
+        return CHOOSING_ROLE
+    
+    async def _cb_help(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+        """Show the help text"""
+        await self.show_help(update, context)
+        return CHOOSING_ROLE
+    
+    async def _cb_ai_chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+        """Open the AI chat menu"""
+        await self.show_ai_chat_menu(update, context)
+        return AI_CHAT
+    
+    async def _cb_back_to_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+        """Return to the main menu"""
+        await self.show_role_menu(update, context)
+        return CHOOSING_ROLE
+    
+    async def _cb_blocks_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+        """Blocked users list opened from the main menu"""
+        # Show block list for main menu (only for admins)
+        if not self.is_admin_user(query.from_user.id):
+            await query.answer("❌ فقط مسئولین می‌توانند لیست کاربران بلاک شده را مشاهده کنند.")
             return CHOOSING_ROLE
         
-        elif query.data == "help":
-            await self.show_help(update, context)
-            return CHOOSING_ROLE
+        # Get blocked users for this admin
+        blocked_users = await asyncio.to_thread(self.db.get_blocked_users, query.from_user.id)
         
-        elif query.data == "ai_chat":
-            await self.show_ai_chat_menu(update, context)
-            return AI_CHAT
+        if not blocked_users:
+            text = "📋 **لیست کاربران بلاک شده:**\n\n"
+            text += "✅ هیچ کاربری بلاک نشده است."
+        else:
+            text = "📋 **لیست کاربران بلاک شده:**\n\n"
+            for i, user in enumerate(blocked_users, 1):
+                text += f"{i}. **شناسه:** `{user['user_id']}`\n"
+                text += f"   **تاریخ بلاک:** {user['blocked_at']}\n"
+                text += f"   **دلیل:** {user['reason']}\n\n"
+        
+        # Create back button
+        reply_markup = BACK_MARKUP
+        
+        await query.edit_message_text(
+            text=text,
+            reply_markup=reply_markup,
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return CHOOSING_ROLE
+    
+    async def _cb_send_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+        """Switch to the message typing interface"""
+        # Create reply keyboard for typing
+        reply_markup_keyboard = TYPING_REPLY_MARKUP
         
-        elif query.data == "back_to_menu":
+        # Edit the message to show typing interface
+        await query.edit_message_text(
+            text="📝 **ارسال پیام**\n\n"
+            "💬 **حالا پیام خود را تایپ کنید:**\n\n"
+            "برای لغو، روی دکمه «🔙 بازگشت» کلیک کنید.",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        
+        # Send a separate message with reply keyboard
+        await context.bot.send_message(
+            chat_id=query.from_user.id,
+            text="⌨️ **دکمه‌های زیر را برای ناوبری استفاده کنید:**",
+            reply_markup=reply_markup_keyboard,
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return WAITING_FOR_MESSAGE
+    
+    async def _cb_back_to_role(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+        """Return to the conversation with the selected role"""
+        # Go back to role selection for current role
+        user_id = query.from_user.id
+        if user_id in self.user_states:
+            role = self.user_states[user_id]['selected_role']
+            thread_id = self.user_states[user_id].get('thread_id')
+            
+            if thread_id:
+                await query.edit_message_text(
+                    text=self.role_view_text(role, thread_id),
+                    reply_markup=SEND_OR_MENU_MARKUP,
+                    parse_mode=ParseMode.MARKDOWN
+                )
+            else:
+                await self.show_role_menu(update, context)
+            return CHOOSING_ROLE
+        else:
             await self.show_role_menu(update, context)
             return CHOOSING_ROLE
+    
+    async def _cb_block(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+        """Block a user from an admin message"""
+        # Check if user is admin
+        if not self.is_admin_user(query.from_user.id):
+            await query.answer("❌ فقط مسئولین می‌توانند کاربران را بلاک کنند.")
+            return CHOOSING_ROLE
         
-        elif query.data == "blocks_main_menu":
-            # Show block list for main menu (only for admins)
-            if not self.is_admin_user(query.from_user.id):
-                await query.answer("❌ فقط مسئولین می‌توانند لیست کاربران بلاک شده را مشاهده کنند.")
-                return CHOOSING_ROLE
+        # Parse block data: block_user_id_thread_id
+        parts = query.data.split("_")
+        if len(parts) >= 3:
+            blocked_user_id = int(parts[1])
+            thread_id = int(parts[2])
             
-            # Get blocked users for this admin
-            blocked_users = self.db.get_blocked_users(query.from_user.id)
+            # Block the user
+            await asyncio.to_thread(self.db.block_user, query.from_user.id, blocked_user_id, "بلاک شده توسط مسئول")
+            (await self._blocked_set(query.from_user.id)).add(blocked_user_id)
             
-            if not blocked_users:
-                text = "📋 **لیست کاربران بلاک شده:**\n\n"
-                text += "✅ هیچ کاربری بلاک نشده است."
-            else:
-                text = "📋 **لیست کاربران بلاک شده:**\n\n"
-                for i, user in enumerate(blocked_users, 1):
-                    text += f"{i}. **شناسه:** `{user['user_id']}`\n"
-                    text += f"   **تاریخ بلاک:** {user['blocked_at']}\n"
-                    text += f"   **دلیل:** {user['reason']}\n\n"
-            
-            # Create back button
-            keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            # Create new keyboard with unblock button
+            new_keyboard = [
+                [InlineKeyboardButton("🔓 خارج کردن از بلاک", callback_data=f"unblock_{blocked_user_id}_{thread_id}")],
+                [InlineKeyboardButton("📋 لیست کاربران بلاک شده", callback_data=f"blocks_{query.from_user.id}")]
+            ]
+            new_reply_markup = InlineKeyboardMarkup(new_keyboard)
             
+            # Update the message to show user is blocked with new keyboard
             await query.edit_message_text(
-                text=text,
-                reply_markup=reply_markup,
-                parse_mode=ParseMode.MARKDOWN
+                text=f"✅ **کاربر بلاک شد!**\n\n"
+                f"🆔 شناسه کاربر: `{blocked_user_id}`\n"
+                f"🆔 شناسه گفتگو: #{thread_id}\n\n"
+                f"کاربر دیگر نمی‌تواند پیام ارسال کند.",
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=new_reply_markup
             )
+        return CHOOSING_ROLE
+    
+    async def _cb_unblock(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+        """Unblock a user from an admin message"""
+        # Check if user is admin
+        if not self.is_admin_user(query.from_user.id):
+            await query.answer("❌ فقط مسئولین می‌توانند کاربران را از بلاک خارج کنند.")
             return CHOOSING_ROLE
         
-        elif query.data == "send_message":
-            # Create reply keyboard for typing
-            reply_keyboard = [
-                [KeyboardButton("🔙 بازگشت")],
-                [KeyboardButton("🏠 منوی اصلی")]
+        # Parse unblock data: unblock_user_id_thread_id
+        parts = query.data.split("_")
+        if len(parts) >= 3:
+            blocked_user_id = int(parts[1])
+            thread_id = int(parts[2])
+            
+            # Unblock the user
+            await asyncio.to_thread(self.db.unblock_user, query.from_user.id, blocked_user_id)
+            (await self._blocked_set(query.from_user.id)).discard(blocked_user_id)
+            
+            # Create new keyboard with block button
+            new_keyboard = [
+                [InlineKeyboardButton("🔒 بلاک کاربر", callback_data=f"block_{blocked_user_id}_{thread_id}")],
+                [InlineKeyboardButton("📋 لیست کاربران بلاک شده", callback_data=f"blocks_{query.from_user.id}")]
             ]
-            reply_markup_keyboard = ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True, one_time_keyboard=False)
+            new_reply_markup = InlineKeyboardMarkup(new_keyboard)
             
-            # Edit the message to show typing interface
+            # Update the message to show user is unblocked with new keyboard
+            await query.edit_message_text(
+                text=f"✅ **کاربر از بلاک خارج شد!**\n\n"
+                f"🆔 شناسه کاربر: `{blocked_user_id}`\n"
+                f"🆔 شناسه گفتگو: #{thread_id}\n\n"
+                f"کاربر می‌تواند دوباره پیام ارسال کند.",
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=new_reply_markup
+            )
+        return CHOOSING_ROLE
+    
+    async def _cb_blocks(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+        """Blocked users list of an admin"""
+        # Check if user is admin
+        if not self.is_admin_user(query.from_user.id):
+            await query.answer("❌ فقط مسئولین می‌توانند لیست کاربران بلاک شده را مشاهده کنند.")
+            return CHOOSING_ROLE
+        
+        # Parse admin user ID
+        admin_user_id = int(query.data.split("_")[1])
+        
+        # Get blocked users
+        blocked_users = await asyncio.to_thread(self.db.get_blocked_users, admin_user_id)
+        
+        if not blocked_users:
             await query.edit_message_text(
-                text="📝 **ارسال پیام**\n\n"
-                "💬 **حالا پیام خود را تایپ کنید:**\n\n"
-                "برای لغو، روی دکمه «🔙 بازگشت» کلیک کنید.",
+                text="📋 **لیست کاربران بلاک شده**\n\n"
+                "هیچ کاربری بلاک نشده است.",
                 parse_mode=ParseMode.MARKDOWN
             )
+        else:
+            text = "📋 **لیست کاربران بلاک شده:**\n\n"
+            for i, blocked in enumerate(blocked_users[:10], 1):  # Show first 10
+                text += f"{i}. شناسه: `{blocked['user_id']}`\n"
+                text += f"   تاریخ: {blocked['blocked_at'][:16]}\n"
+                if blocked['reason']:
+                    text += f"   دلیل: {blocked['reason']}\n"
+                text += "\n"
             
-            # Send a separate message with reply keyboard
-            await context.bot.send_message(
-                chat_id=query.from_user.id,
-                text="⌨️ **دکمه‌های زیر را برای ناوبری استفاده کنید:**",
-                reply_markup=reply_markup_keyboard,
+            await query.edit_message_text(
+                text=text,
                 parse_mode=ParseMode.MARKDOWN
             )
-            return WAITING_FOR_MESSAGE
+        return CHOOSING_ROLE
+    
+    async def _cb_role(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+        """Open a conversation with the chosen role"""
+        role_id = int(query.data.split("_")[1])
+        role = self.db.get_role_by_id(role_id)
         
-
+        if not role:
+            await query.edit_message_text("❌ خطا: مسئول مورد نظر یافت نشد.")
+            return ConversationHandler.END
         
-        elif query.data == "back_to_role":
-            # Go back to role selection for current role
-            user_id = query.from_user.id
-            if user_id in self.user_states:
-                role = self.user_states[user_id]['selected_role']
-                thread_id = self.user_states[user_id].get('thread_id')
-                
-                if thread_id:
-                    keyboard = [
-                        [InlineKeyboardButton("📝 ارسال پیام", callback_data="send_message")],
-                        [InlineKeyboardButton("🏠 منوی اصلی", callback_data="back_to_menu")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await query.edit_message_text(
-                        text=f"✅ **گفتگو با {role['role_name']}**\n\n"
-                        f"🆔 شناسه گفتگو: #{thread_id}\n\n"
-                        f"برای ارسال پیام، روی «📝 ارسال پیام» کلیک کنید.",
-                        reply_markup=reply_markup,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                else:
-                    await self.show_role_menu(update, context)
-                return CHOOSING_ROLE
-            else:
-                await self.show_role_menu(update, context)
-                return CHOOSING_ROLE
-        
-        # Handle block buttons for admins
-        elif query.data.startswith("block_"):
-            # Check if user is admin
-            if not self.is_admin_user(query.from_user.id):
-                await query.answer("❌ فقط مسئولین می‌توانند کاربران را بلاک کنند.")
-                return CHOOSING_ROLE
-            
-            # Parse block data: block_user_id_thread_id
-            parts = query.data.split("_")
-            if len(parts) >= 3:
-                blocked_user_id = int(parts[1])
-                thread_id = int(parts[2])
-                
-                # Block the user
-                self.db.block_user(query.from_user.id, blocked_user_id, "بلاک شده توسط مسئول")
-                
-                # Create new keyboard with unblock button
-                new_keyboard = [
-                    [InlineKeyboardButton("🔓 خارج کردن از بلاک", callback_data=f"unblock_{blocked_user_id}_{thread_id}")],
-                    [InlineKeyboardButton("📋 لیست کاربران بلاک شده", callback_data=f"blocks_{query.from_user.id}")]
-                ]
-                new_reply_markup = InlineKeyboardMarkup(new_keyboard)
-                
-                # Update the message to show user is blocked with new keyboard
-                await query.edit_message_text(
-                    text=f"✅ **کاربر بلاک شد!**\n\n"
-                    f"🆔 شناسه کاربر: `{blocked_user_id}`\n"
-                    f"🆔 شناسه گفتگو: #{thread_id}\n\n"
-                    f"کاربر دیگر نمی‌تواند پیام ارسال کند.",
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=new_reply_markup
-                )
-            return CHOOSING_ROLE
+        # Check if user is blocked by this specific admin
+        user_id = query.from_user.id
+        admin_user_id = role['user_id']
+        is_blocked = await self.is_user_blocked(admin_user_id, user_id)
         
-        elif query.data.startswith("unblock_"):
-            # Check if user is admin
-            if not self.is_admin_user(query.from_user.id):
-                await query.answer("❌ فقط مسئولین می‌توانند کاربران را از بلاک خارج کنند.")
-                return CHOOSING_ROLE
-            
-            # Parse unblock data: unblock_user_id_thread_id
-            parts = query.data.split("_")
-            if len(parts) >= 3:
-                blocked_user_id = int(parts[1])
-                thread_id = int(parts[2])
-                
-                # Unblock the user
-                self.db.unblock_user(query.from_user.id, blocked_user_id)
-                
-                # Create new keyboard with block button
-                new_keyboard = [
-                    [InlineKeyboardButton("🔒 بلاک کاربر", callback_data=f"block_{blocked_user_id}_{thread_id}")],
-                    [InlineKeyboardButton("📋 لیست کاربران بلاک شده", callback_data=f"blocks_{query.from_user.id}")]
-                ]
-                new_reply_markup = InlineKeyboardMarkup(new_keyboard)
-                
-                # Update the message to show user is unblocked with new keyboard
-                await query.edit_message_text(
-                    text=f"✅ **کاربر از بلاک خارج شد!**\n\n"
-                    f"🆔 شناسه کاربر: `{blocked_user_id}`\n"
-                    f"🆔 شناسه گفتگو: #{thread_id}\n\n"
-                    f"کاربر می‌تواند دوباره پیام ارسال کند.",
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=new_reply_markup
-                )
+        if is_blocked:
+            # User is blocked by this admin - show error message
+            await query.edit_message_text(
+                f"❌ **شما توسط {role['role_name']} بلاک شده‌اید.**\n\n"
+                f"نمی‌توانید با این مسئول ارتباط برقرار کنید.\n"
+                f"لطفاً مسئول دیگری انتخاب کنید.",
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=BACK_TO_MENU_MARKUP
+            )
             return CHOOSING_ROLE
         
-        elif query.data.startswith("blocks_"):
-            # Check if user is admin
-            if not self.is_admin_user(query.from_user.id):
-                await query.answer("❌ فقط مسئولین می‌توانند لیست کاربران بلاک شده را مشاهده کنند.")
-                return CHOOSING_ROLE
+        # Store selected role in user state
+        self.user_states[user_id] = {
+            'selected_role': role,
+            'thread_id': None
+        }
+        
+        # Check if there's an active thread for this user and role
+        thread_id = await asyncio.to_thread(self.db.get_active_thread, user_id, role_id)
+        if thread_id:
+            self.user_states[user_id]['thread_id'] = thread_id
             
-            # Parse admin user ID
-            admin_user_id = int(query.data.split("_")[1])
+            # Show active thread with inline keyboard
+            reply_markup = SEND_OR_MENU_MARKUP
             
-            # Get blocked users
-            blocked_users = self.db.get_blocked_users(admin_user_id)
+            await query.edit_message_text(
+                text=f"✅ **گفتگوی فعال یافت شد!**\n\n"
+                f"مسئول: {role['role_name']}\n"
+                f"🆔 شناسه گفتگو: #{thread_id}\n\n"
+                f"برای ارسال پیام، روی «📝 ارسال پیام» کلیک کنید.",
+                reply_markup=reply_markup,
+                parse_mode=ParseMode.MARKDOWN
+            )
+        else:
+            # Show new conversation with inline keyboard
+            reply_markup = SEND_OR_MENU_MARKUP
             
-            if not blocked_users:
-                await query.edit_message_text(
-                    text="📋 **لیست کاربران بلاک شده**\n\n"
-                    "هیچ کاربری بلاک نشده است.",
+            await query.edit_message_text(
+                text=f"✅ **مسئول انتخاب شد!**\n\n"
+                f"مسئول: {role['role_name']}\n\n"
+                f"برای ارسال پیام، روی «📝 ارسال پیام» کلیک کنید.\n\n"
+                f"⚠️ توجه: پیام‌ها ناشناس نیستند و اطلاعات شما برای مسئول ارسال می‌شود.",
+                reply_markup=reply_markup,
+                parse_mode=ParseMode.MARKDOWN
+            )
+        
+        return CHOOSING_ROLE
+    
+    async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle user messages"""
+        user_id = update.effective_user.id
+        message_text = update.message.text
+        
+        # Reply keyboard buttons are pure navigation: no rate limit, thread or database work
+        if message_text == "🔙 بازگشت":
+            # Remove reply keyboard
+            await context.bot.send_message(
+                chat_id=user_id,
+                text="🔙 بازگشت به منوی مسئول",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            # Go back to role view - create role view directly
+            user_state = self.user_states.get(user_id)
+            if user_state:
+                await context.bot.send_message(
+                    chat_id=user_id,
+                    text=self.role_view_text(user_state['selected_role'], user_state.get('thread_id')),
+                    reply_markup=SEND_OR_MENU_MARKUP,
                     parse_mode=ParseMode.MARKDOWN
                 )
             else:
-                text = "📋 **لیست کاربران بلاک شده:**\n\n"
-                for i, blocked in enumerate(blocked_users[:10], 1):  # Show first 10
-                    text += f"{i}. شناسه: `{blocked['user_id']}`\n"
-                    text += f"   تاریخ: {blocked['blocked_at'][:16]}\n"
-                    if blocked['reason']:
-                        text += f"   دلیل: {blocked['reason']}\n"
-                    text += "\n"
-                
-                await query.edit_message_text(
-                    text=text,
-                    parse_mode=ParseMode.MARKDOWN
-                )
+                await self.show_role_menu(update, context)
             return CHOOSING_ROLE
         
-        elif query.data.startswith("role_"):
-            role_id = int(query.data.split("_")[1])
-            role = self.db.get_role_by_id(role_id)
-            
-            if not role:
-                await query.edit_message_text("❌ خطا: مسئول مورد نظر یافت نشد.")
-                return ConversationHandler.END
-            
-            # Check if user is blocked by this specific admin
-            user_id = query.from_user.id
-            admin_user_id = role['user_id']
-            is_blocked = self.db.is_user_blocked(admin_user_id, user_id)
-            
-            if is_blocked:
-                # User is blocked by this admin - show error message
-                await query.edit_message_text(
-                    f"❌ **شما توسط {role['role_name']} بلاک شده‌اید.**\n\n"
-                    f"نمی‌توانید با این مسئول ارتباط برقرار کنید.\n"
-                    f"لطفاً مسئول دیگری انتخاب کنید.",
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🏠 منوی اصلی", callback_data="back_to_menu")
-                    ]])
-                )
-                return CHOOSING_ROLE
-            
-            # Store selected role in user state
-            self.user_states[user_id] = {
-                'selected_role': role,
-                'thread_id': None
-            }
-            
-            # Check if there's an active thread for this user and role
-            thread_id = self.db.get_active_thread(user_id, role_id)
-            if thread_id:
-                self.user_states[user_id]['thread_id'] = thread_id
-                
-                # Show active thread with inline keyboard
-                keyboard = [
-                    [InlineKeyboardButton("📝 ارسال پیام", callback_data="send_message")],
-                    [InlineKeyboardButton("🏠 منوی اصلی", callback_data="back_to_menu")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    text=f"✅ **گفتگوی فعال یافت شد!**\n\n"
-                    f"مسئول: {role['role_name']}\n"
-                    f"🆔 شناسه گفتگو: #{thread_id}\n\n"
-                    f"برای ارسال پیام، روی «📝 ارسال پیام» کلیک کنید.",
-                    reply_markup=reply_markup,
-                    parse_mode=ParseMode.MARKDOWN
-                )
-            else:
-                # Show new conversation with inline keyboard
-                keyboard = [
-                    [InlineKeyboardButton("📝 ارسال پیام", callback_data="send_message")],
-                    [InlineKeyboardButton("🏠 منوی اصلی", callback_data="back_to_menu")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    text=f"✅ **مسئول انتخاب شد!**\n\n"
-                    f"مسئول: {role['role_name']}\n\n"
-                    f"برای ارسال پیام، روی «📝 ارسال پیام» کلیک کنید.\n\n"
-                    f"⚠️ توجه: پیام‌ها ناشناس نیستند و اطلاعات شما برای مسئول ارسال می‌شود.",
-                    reply_markup=reply_markup,
-                    parse_mode=ParseMode.MARKDOWN
-                )
-            
+        elif message_text == "🏠 منوی اصلی":
+            # Remove reply keyboard
+            await context.bot.send_message(
+                chat_id=user_id,
+                text="🏠 بازگشت به منوی اصلی",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            # Go back to main menu
+            await self.show_role_menu(update, context)
             return CHOOSING_ROLE
-    
-    async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle user messages"""
-        user_id = update.effective_user.id
         
         if user_id not in self.user_states:
             back_to_menu_markup = self.create_back_to_menu_button()
@@ -522,86 +657,21 @@ class EnhancedCouncilBot:
         
         # If no active thread, create one
         if not thread_id:
-            thread_id = self.db.create_thread(user_id, role['role_id'])
+            thread_id = await asyncio.to_thread(self.db.create_thread, user_id, role['role_id'])
             self.user_states[user_id]['thread_id'] = thread_id
         
-        message_text = update.message.text
-        
-        # Handle reply keyboard buttons
-        if message_text == "🔙 بازگشت":
-            # Remove reply keyboard
-            remove_keyboard = ReplyKeyboardRemove()
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="🔙 بازگشت به منوی مسئول",
-                reply_markup=remove_keyboard
-            )
-            # Go back to role view - create role view directly
-            user_id = update.effective_user.id
-            if user_id in self.user_states:
-                role = self.user_states[user_id]['selected_role']
-                thread_id = self.user_states[user_id].get('thread_id')
-                
-                if thread_id:
-                    keyboard = [
-                        [InlineKeyboardButton("📝 ارسال پیام", callback_data="send_message")],
-                        [InlineKeyboardButton("🏠 منوی اصلی", callback_data="back_to_menu")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=f"✅ **گفتگو با {role['role_name']}**\n\n"
-                        f"🆔 شناسه گفتگو: #{thread_id}\n\n"
-                        f"برای ارسال پیام، روی «📝 ارسال پیام» کلیک کنید.",
-                        reply_markup=reply_markup,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                else:
-                    keyboard = [
-                        [InlineKeyboardButton("📝 ارسال پیام", callback_data="send_message")],
-                        [InlineKeyboardButton("🏠 منوی اصلی", callback_data="back_to_menu")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=f"✅ **مسئول انتخاب شده**\n\n"
-                        f"مسئول: {role['role_name']}\n\n"
-                        f"برای ارسال پیام، روی «📝 ارسال پیام» کلیک کنید.",
-                        reply_markup=reply_markup,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-            return CHOOSING_ROLE
-        
-        elif message_text == "🏠 منوی اصلی":
-            # Remove reply keyboard
-            remove_keyboard = ReplyKeyboardRemove()
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="🏠 بازگشت به منوی اصلی",
-                reply_markup=remove_keyboard
-            )
-            # Go back to main menu
-            await self.show_role_menu(update, context)
-            return CHOOSING_ROLE
-        
-        # Store user message
-        self.db.add_message(
-            thread_id=thread_id,
-            telegram_message_id=update.message.message_id,
-            sender_type='user',
-            message_text=message_text
-        )
+        # User message row, stored together with the admin copy once that has been sent
+        user_row = (thread_id, update.message.message_id, 'user', message_text)
         
         # Send notification to admin
         admin_user_id = role['user_id']
         
         # Check if user is blocked by this specific admin
-        is_blocked = self.db.is_user_blocked(admin_user_id, update.effective_user.id)
+        is_blocked = await self.is_user_blocked(admin_user_id, update.effective_user.id)
         
         if is_blocked:
             # User is blocked by this admin - don't send message to admin
+            self.db.add_message(*user_row)
             await update.message.reply_text(
                 f"❌ **شما توسط {role['role_name']} بلاک شده‌اید.**\n\n"
                 f"نمی‌توانید به این مسئول پیام ارسال کنید.\n"
@@ -612,21 +682,24 @@ class EnhancedCouncilBot:
             return WAITING_FOR_MESSAGE
         
         # Create admin notification message
+        # (HTML with the user-supplied parts escaped once; a stray * or _ in them broke Markdown sends)
         username = update.effective_user.username
         username_display = f"@{username}" if username else "بدون نام کاربری"
+        first_name_html = html.escape(update.effective_user.first_name or 'بدون نام')
+        message_html = html.escape(message_text)
         
         admin_message = f"""
-📨 **پیام جدید از دانشجو**
+📨 <b>پیام جدید از دانشجو</b>
 
-👤 **اطلاعات دانشجو:**
-🆔 شناسه: `{update.effective_user.id}`
-👤 نام: {update.effective_user.first_name or 'بدون نام'}
+👤 <b>اطلاعات دانشجو:</b>
+🆔 شناسه: <code>{update.effective_user.id}</code>
+👤 نام: {first_name_html}
 📝 نام کاربری: {username_display}
 
-💬 **پیام:**
-{message_text}
+💬 <b>پیام:</b>
+{message_html}
 
-🆔 **شناسه گفتگو:** #{thread_id}
+🆔 <b>شناسه گفتگو:</b> #{thread_id}
 
 ---
 برای پاسخ، روی این پیام ریپلای کنید.
@@ -640,44 +713,38 @@ class EnhancedCouncilBot:
         
         # Send to channel for logging
         channel_message = f"""
-📨 **پیام جدید در کانال لاگ**
+📨 <b>پیام جدید در کانال لاگ</b>
 
-👤 **دانشجو:** {update.effective_user.id} | {username_display} | {update.effective_user.first_name}
-💬 **پیام:** {message_text}
-🆔 **گفتگو:** #{thread_id}
-👨‍💼 **مسئول:** {role['role_name']}
+👤 <b>دانشجو:</b> {update.effective_user.id} | {username_display} | {first_name_html}
+💬 <b>پیام:</b> {message_html}
+🆔 <b>گفتگو:</b> #{thread_id}
+👨‍💼 <b>مسئول:</b> {html.escape(role['role_name'])}
         """
-        await self.send_to_channel(context, channel_message)
+        # Log to the channel while the admin copy is being delivered
+        channel_task = asyncio.create_task(self.send_to_channel(context, channel_message))
         
+        stored = False
         try:
             sent_msg = await context.bot.send_message(
                 chat_id=admin_user_id,
                 text=admin_message,
-                parse_mode=ParseMode.MARKDOWN,
+                parse_mode=ParseMode.HTML,
                 reply_markup=admin_reply_markup
             )
             
             # Store the mapping between role message and thread
-            self.message_thread_map[sent_msg.message_id] = thread_id
+            self.remember_message_mapping(sent_msg.message_id, thread_id)
             
-            # Add role message to database
-            self.db.add_message(
-                thread_id=thread_id,
-                telegram_message_id=sent_msg.message_id,
-                sender_type='admin',
-                message_text=f"پیام کاربر (Thread #{thread_id}): {message_text}"
+            # User message, role message and the mapping go in as one queue item, so one commit
+            self.db.add_messages(
+                [user_row,
+                 (thread_id, sent_msg.message_id, 'admin', f"پیام کاربر (Thread #{thread_id}): {message_text}")],
+                [(sent_msg.message_id, thread_id)]
             )
-            
-            # Save the mapping to database for persistence
-            self.save_message_mapping(sent_msg.message_id, thread_id)
+            stored = True
             
             # Confirm to user
-            keyboard = [
-                [InlineKeyboardButton("📝 ارسال پیام دیگر", callback_data="send_message")],
-                [InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_role")],
-                [InlineKeyboardButton("🏠 منوی اصلی", callback_data="back_to_menu")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = MESSAGE_SENT_MARKUP
             
             await update.message.reply_text(
                 f"✅ **پیام شما ارسال شد!**\n\n"
@@ -693,11 +760,17 @@ class EnhancedCouncilBot:
             
         except Exception as e:
             logger.error(f"Error sending message to admin: {e}")
+            if not stored:
+                # The admin copy never went out, but the user's message is still kept
+                self.db.add_message(*user_row)
             back_to_menu_markup = self.create_back_to_menu_button()
             await update.message.reply_text(
                 "❌ خطا در ارسال پیام. لطفاً دوباره تلاش کنید.",
                 reply_markup=back_to_menu_markup
             )
+        finally:
+            # Awaited even when the error reply itself fails, so the log task is never left orphaned
+            await channel_task
         
         return WAITING_FOR_MESSAGE
     
@@ -710,7 +783,7 @@ class EnhancedCouncilBot:
             # Show thread history
             thread_id = user_state.get('thread_id')
             if thread_id:
-                messages = self.db.get_thread_messages(thread_id)
+                messages = await asyncio.to_thread(self.db.get_thread_messages, thread_id)
                 if messages:
                     text = f"📋 **تاریخچه گفتگو #{thread_id}:**\n\n"
                     for msg in messages[-10:]:  # Show last 10 messages
@@ -731,10 +804,19 @@ class EnhancedCouncilBot:
             await self.show_role_menu(update, context)
             return CHOOSING_ROLE
     
+    def role_view_text(self, role: Dict[str, Any], thread_id: Optional[int]) -> str:
+        """Text of the view of the selected role, with its conversation if one exists"""
+        if thread_id:
+            return (f"✅ **گفتگو با {role['role_name']}**\n\n"
+                    f"🆔 شناسه گفتگو: #{thread_id}\n\n"
+                    f"برای ارسال پیام، روی «📝 ارسال پیام» کلیک کنید.")
+        return (f"✅ **مسئول انتخاب شده**\n\n"
+                f"مسئول: {role['role_name']}\n\n"
+                f"برای ارسال پیام، روی «📝 ارسال پیام» کلیک کنید.")
+    
     def create_back_to_menu_button(self) -> InlineKeyboardMarkup:
         """Create a back to main menu button"""
-        keyboard = [[InlineKeyboardButton("🏠 منوی اصلی", callback_data="back_to_menu")]]
-        return InlineKeyboardMarkup(keyboard)
+        return BACK_TO_MENU_MARKUP
 
     async def handle_admin_reply(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle replies to admin messages (both from admins and regular users)"""
@@ -747,30 +829,26 @@ class EnhancedCouncilBot:
         user_id = update.effective_user.id
         is_admin = self.is_admin_user(user_id)
         
-        # Log the reply attempt
-        logger.info(f"Reply to admin message from user {user_id} (admin: {is_admin})")
-        
-        # Log admin action for security
-        logger.info(f"Admin reply from user {user_id} for message {update.message.reply_to_message.message_id}")
-        
         # Get the original message that was replied to
         original_message_id = update.message.reply_to_message.message_id
         admin_message = update.message.text
         
-        # Debug: Log all message mappings
-        logger.info(f"Message thread map contents: {self.message_thread_map}")
-        logger.info(f"Looking for message ID: {original_message_id}")
-        logger.info(f"Admin message: {admin_message}")
-        logger.info(f"Reply message text: {update.message.text}")
-        logger.info(f"Reply message ID: {update.message.message_id}")
-        logger.info(f"Original message ID: {original_message_id}")
+        # Log the reply attempt (also the admin action record for security)
+        logger.info(f"Reply from user {user_id} (admin: {is_admin}) to message {original_message_id}")
+        
+        # Debug details, %-style so nothing is formatted unless DEBUG is on
+        logger.debug("Message thread map size=%d, reply message ID=%d, text=%r",
+                     len(self.message_thread_map), update.message.message_id, admin_message)
         
         # Find the thread for this message - try both direct mapping and database lookup
         thread_id = self.message_thread_map.get(original_message_id)
+        if thread_id:
+            self.message_thread_map.move_to_end(original_message_id)
         
         # If not found in memory, try to find it in the database
         if not thread_id:
             try:
+                await asyncio.to_thread(self.db.flush)
                 conn = sqlite3.connect(self.db.db_path)
                 cursor = conn.cursor()
                 
@@ -827,11 +905,11 @@ class EnhancedCouncilBot:
                 if result:
                     thread_id = result[0]
                     # Add to memory mapping for future use
-                    self.message_thread_map[original_message_id] = thread_id
+                    self.remember_message_mapping(original_message_id, thread_id)
                     logger.info(f"Found thread {thread_id} for message {original_message_id} in database")
                 else:
                     logger.warning(f"No thread found for message {original_message_id} in database")
-                    logger.warning(f"Available message IDs: {list(self.message_thread_map.keys())}")
+                    logger.warning(f"Cached message mappings: {len(self.message_thread_map)}")
                     await update.message.reply_text("❌ پیام مورد نظر یافت نشد. لطفاً روی پیام اصلی ریپلای کنید.")
                     return
             except Exception as e:
@@ -874,7 +952,7 @@ class EnhancedCouncilBot:
             logger.info(f"Admin reply - Will send reply to chat_id: {student_user_id}")
             
             # Check if user is blocked
-            if self.db.is_user_blocked(user_id, student_user_id):
+            if await self.is_user_blocked(user_id, student_user_id):
                 await update.message.reply_text("❌ این کاربر توسط شما بلاک شده است.")
                 return
         
@@ -882,19 +960,21 @@ class EnhancedCouncilBot:
             if reply_message.startswith('/block'):
                 # Block the user
                 reason = reply_message[7:].strip() if len(reply_message) > 7 else None
-                self.db.block_user(user_id, student_user_id, reason)
+                await asyncio.to_thread(self.db.block_user, user_id, student_user_id, reason)
+                (await self._blocked_set(user_id)).add(student_user_id)
                 await update.message.reply_text(f"✅ کاربر بلاک شد.\nدلیل: {reason or 'بدون دلیل'}")
                 return
             
             if reply_message.startswith('/unblock'):
                 # Unblock the user
-                self.db.unblock_user(user_id, student_user_id)
+                await asyncio.to_thread(self.db.unblock_user, user_id, student_user_id)
+                (await self._blocked_set(user_id)).discard(student_user_id)
                 await update.message.reply_text("✅ کاربر از بلاک خارج شد.")
                 return
             
             if reply_message.startswith('/blocks'):
                 # List blocked users
-                blocked_users = self.db.get_blocked_users(user_id)
+                blocked_users = await asyncio.to_thread(self.db.get_blocked_users, user_id)
                 if not blocked_users:
                     await update.message.reply_text("📋 هیچ کاربری بلاک نشده است.")
                     return
@@ -914,7 +994,7 @@ class EnhancedCouncilBot:
             logger.info(f"User reply - Will send reply to admin chat_id: {admin_user_id}")
             
             # Check if user is blocked by admin
-            if admin_user_id and self.db.is_user_blocked(admin_user_id, user_id):
+            if admin_user_id and await self.is_user_blocked(admin_user_id, user_id):
                 await update.message.reply_text("❌ شما توسط این مسئول بلاک شده‌اید.")
                 return
         
@@ -961,6 +1041,7 @@ class EnhancedCouncilBot:
                 sender_name = "دانشجو"
             
             # Find the original message to reply to
+            await asyncio.to_thread(self.db.flush)
             conn = sqlite3.connect(self.db.db_path)
             cursor = conn.cursor()
             if is_admin:
@@ -1004,16 +1085,17 @@ class EnhancedCouncilBot:
 💬 <b>پاسخ</b>
 
 🆔 <b>شناسه گفتگو:</b> #{thread_id}
-👤 <b>از:</b> {sender_name}
-📝 <b>به:</b> {'دانشجو' if is_admin else role_name}
-📝 <b>پیام:</b> {reply_message}
-👤 <b>دانشجو:</b> {student_display}
+👤 <b>از:</b> {html.escape(sender_name)}
+📝 <b>به:</b> {'دانشجو' if is_admin else html.escape(role_name)}
+📝 <b>پیام:</b> {html.escape(reply_message)}
+👤 <b>دانشجو:</b> {html.escape(student_display)}
             """
-            await self.send_to_channel(context, channel_reply_message)
-            
             # Send reply
             logger.info(f"Sending reply to {target_user_id} with text: {reply_text[:100]}...")
             
+            # Log to the channel while the reply is being delivered
+            channel_task = asyncio.create_task(self.send_to_channel(context, channel_reply_message))
+            
             try:
                 sent_message = None
                 if msg_result:
@@ -1029,7 +1111,7 @@ class EnhancedCouncilBot:
                         )
                     else:
                         # Student sending reply to admin - add block buttons
-                        is_blocked = self.db.is_user_blocked(admin_user_id, student_user_id)
+                        is_blocked = await self.is_user_blocked(admin_user_id, student_user_id)
                         
                         if is_blocked:
                             # User is blocked - show unblock button
@@ -1062,7 +1144,7 @@ class EnhancedCouncilBot:
                         )
                     else:
                         # Student sending reply to admin - add block buttons
-                        is_blocked = self.db.is_user_blocked(admin_user_id, student_user_id)
+                        is_blocked = await self.is_user_blocked(admin_user_id, student_user_id)
                         
                         if is_blocked:
                             # User is blocked - show unblock button
@@ -1102,6 +1184,9 @@ class EnhancedCouncilBot:
                     await update.message.reply_text(f"❌ خطا در ارسال پاسخ به دانشجو: {str(send_error)}")
                 else:
                     await update.message.reply_text(f"❌ خطا در ارسال پاسخ به {sender_name}: {str(send_error)}")
+            finally:
+                # Awaited even when the error reply itself fails, so the log task is never left orphaned
+                await channel_task
             
         except Exception as e:
             logger.error(f"Error forwarding reply: {e}")
@@ -1166,6 +1251,7 @@ class EnhancedCouncilBot:
         
         # Also show recent threads
         try:
+            await asyncio.to_thread(self.db.flush)
             conn = sqlite3.connect(self.db.db_path)
             cursor = conn.cursor()
             cursor.execute('''
@@ -1301,6 +1387,7 @@ class EnhancedCouncilBot:
         # Show recent threads for admin
         elif message_text == '/threads':
             try:
+                await asyncio.to_thread(self.db.flush)
                 conn = sqlite3.connect(self.db.db_path)
                 cursor = conn.cursor()
                 cursor.execute('''
@@ -1356,8 +1443,7 @@ class EnhancedCouncilBot:
 • "آخرین اخبار شورای صنفی چیست؟"
         """
         
-        keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = BACK_MARKUP
         
         await query.edit_message_text(
             text=ai_chat_text,
@@ -1388,8 +1474,7 @@ class EnhancedCouncilBot:
 • می‌توانید در هر زمان مسئول را تغییر دهید
         """
         
-        keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = BACK_MARKUP
         
         await query.edit_message_text(
             text=help_text,
@@ -1413,18 +1498,31 @@ class EnhancedCouncilBot:
                 # Get AI system (lazy loading with thread safety)
                 ai_system = await self.get_ai_system()
                 
-                # Get response from AI with improved filtering
-                response = ai_system.query(question)
+                # Stream the answer into the wait message as it is generated
+                from langchain_rag_system import STREAM_RESET
+                response = ""
+                loop = asyncio.get_running_loop()
+                last_edit = loop.time()
+                async for delta in ai_system.aquery(question):
+                    if delta is STREAM_RESET:
+                        # What was streamed so far preceded a tool call, not the answer
+                        response = ""
+                        try:
+                            await wait_message.edit_text("⏳ لطفا منتظر بمانید...")
+                        except Exception:
+                            pass
+                        continue
+                    response += delta
+                    if loop.time() - last_edit >= STREAM_EDIT_INTERVAL and response.strip():
+                        try:
+                            await wait_message.edit_text(response[:4096])
+                        except Exception:
+                            pass  # Ignore "not modified" and transient edit errors
+                        last_edit = loop.time()
                 
                 # Post-process response to improve quality
                 response = self.post_process_ai_response(response, question)
                 
-                # Try to delete wait message (ignore errors)
-                try:
-                    await wait_message.delete()
-                except Exception:
-                    pass  # Ignore deletion errors
-                
                 # Send AI response with hyperlinks
                 # Convert markdown links to HTML format for better display
                 import re
@@ -1453,10 +1551,23 @@ class EnhancedCouncilBot:
                 if 'href=' not in response_with_links and ('https://t.me/' in response or 'http://t.me/' in response):
                     response_with_links += "\n\n⚠️ **توجه:** هیچ لینک معتبری در پاسخ یافت نشد."
                 
-                await update.message.reply_text(
-                    f"{response_with_links}",
-                    parse_mode=ParseMode.HTML
-                )
+                # Replace the streamed draft with the formatted answer
+                try:
+                    await wait_message.edit_text(
+                        f"{response_with_links}",
+                        parse_mode=ParseMode.HTML
+                    )
+                except Exception:
+                    # Try to delete wait message (ignore errors)
+                    try:
+                        await wait_message.delete()
+                    except Exception:
+                        pass  # Ignore deletion errors
+                    
+                    await update.message.reply_text(
+                        f"{response_with_links}",
+                        parse_mode=ParseMode.HTML
+                    )
                 
             except ImportError as e:
                 # Try to delete wait message (ignore errors)
@@ -1874,7 +1985,17 @@ class EnhancedCouncilBot:
                 return
             
             # Create application
-            application = Application.builder().token(Config.TELEGRAM_BOT_TOKEN).build()
+            # Updates of different users run concurrently (a long AI answer no longer holds up everyone
+            # else), with enough pooled connections that outgoing requests don't queue for one
+            application = (
+                Application.builder()
+                .token(Config.TELEGRAM_BOT_TOKEN)
+                .concurrent_updates(PerUserUpdateProcessor(Config.CONCURRENT_UPDATES))
+                .connection_pool_size(Config.CONNECTION_POOL_SIZE)
+                .pool_timeout(Config.POOL_TIMEOUT)
+                .post_shutdown(self.close_ai_system)
+                .build()
+            )
             
             # Add conversation handler
             conv_handler = ConversationHandler(
@@ -1951,41 +2072,47 @@ class EnhancedCouncilBot:
     
     def is_admin_user(self, user_id: int) -> bool:
         """Check if user is an authorized admin"""
-        admin_ids = [
-            Config.ROLE_USERS['ROLE_SECRETARY_USER_ID'],
-            Config.ROLE_USERS['ROLE_LEGAL_USER_ID'],
-            Config.ROLE_USERS['ROLE_EDUCATIONAL_1_USER_ID'],
-            Config.ROLE_USERS['ROLE_EDUCATIONAL_2_USER_ID'],
-            Config.ROLE_USERS['ROLE_PUBLICATION_USER_ID'],
-            Config.ADMIN_USER_ID
-        ]
-        return str(user_id) in admin_ids
+        return str(user_id) in self._admin_ids
+    
+    async def _blocked_set(self, admin_user_id) -> Set[int]:
+        """Users blocked by an admin, loaded from the database on first use"""
+        try:
+            admin_user_id = int(admin_user_id)
+        except ValueError:
+            # A role configured with a non-numeric id (e.g. an unfilled placeholder) can never block anyone
+            return set()
+        blocked = self._blocks.get(admin_user_id)
+        if blocked is None:
+            loaded = {int(b['user_id']) for b in await asyncio.to_thread(self.db.get_blocked_users, admin_user_id)}
+            # A concurrent first check may have stored (and updated) the set meanwhile; keep that one
+            blocked = self._blocks.setdefault(admin_user_id, loaded)
+        return blocked
+    
+    async def is_user_blocked(self, admin_user_id, user_id) -> bool:
+        """Check if a user is blocked by an admin, without a database query after the first check"""
+        return user_id in await self._blocked_set(admin_user_id)
     
     def check_rate_limit(self, user_id: int) -> bool:
         """Check if user has exceeded rate limits"""
-        now = datetime.now()
-        
-        # Check 10-minute message limit
-        if user_id not in self.user_message_counts:
-            self.user_message_counts[user_id] = {}
+        recent = self.user_recent_messages.get(user_id)
+        if not recent:
+            return True
         
         # Remove old entries (older than 10 minutes)
-        ten_minutes_ago = now.timestamp() - 600  # 10 minutes in seconds
-        self.user_message_counts[user_id] = {
-            timestamp: count for timestamp, count in self.user_message_counts[user_id].items()
-            if float(timestamp) > ten_minutes_ago
-        }
+        now = time.monotonic()
+        while recent and recent[0] <= now - 600:
+            recent.popleft()
+        if not recent:
+            del self.user_recent_messages[user_id]
+            return True
         
         # Count messages in last 10 minutes
-        recent_count = sum(self.user_message_counts[user_id].values())
-        if recent_count >= Config.MAX_MESSAGES_PER_10_MINUTES:
+        if len(recent) >= Config.MAX_MESSAGES_PER_10_MINUTES:
             return False
         
         # Check message frequency (minimum 10 seconds between messages)
-        if user_id in self.user_last_message:
-            time_diff = now - self.user_last_message[user_id]
-            if time_diff.total_seconds() < 10:
-                return False
+        if now - recent[-1] < 10:
+            return False
         
         return True
     
@@ -1997,11 +2124,13 @@ class EnhancedCouncilBot:
             cursor.execute('''
                 SELECT telegram_message_id, thread_id FROM message_mappings 
                 ORDER BY created_at DESC
-            ''')
+                LIMIT ?
+            ''', (MESSAGE_MAP_CACHE_SIZE,))
             results = cursor.fetchall()
             conn.close()
             
-            for telegram_message_id, thread_id in results:
+            # Oldest first, so the newest mappings are the last to be evicted
+            for telegram_message_id, thread_id in reversed(results):
                 self.message_thread_map[telegram_message_id] = thread_id
             
             logger.info(f"Loaded {len(results)} message mappings from database")
@@ -2009,33 +2138,36 @@ class EnhancedCouncilBot:
         except Exception as e:
             logger.error(f"Error loading message mappings: {e}")
     
+    def remember_message_mapping(self, telegram_message_id: int, thread_id: int):
+        """Cache a message mapping in memory, evicting the least recently used one when full"""
+        self.message_thread_map[telegram_message_id] = thread_id
+        self.message_thread_map.move_to_end(telegram_message_id)
+        if len(self.message_thread_map) > MESSAGE_MAP_CACHE_SIZE:
+            self.message_thread_map.popitem(last=False)
+    
     def save_message_mapping(self, telegram_message_id: int, thread_id: int):
         """Save message mapping to database for persistence"""
         try:
-            conn = sqlite3.connect(self.db.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO message_mappings (telegram_message_id, thread_id)
-                VALUES (?, ?)
-            ''', (telegram_message_id, thread_id))
-            conn.commit()
-            conn.close()
+            # Queued with the message rows so they are committed in the same transaction
+            self.db.add_message_mapping(telegram_message_id, thread_id)
         except Exception as e:
             logger.error(f"Error saving message mapping: {e}")
     
     def update_rate_limit(self, user_id: int):
         """Update rate limiting counters"""
-        now = datetime.now()
-        timestamp = str(now.timestamp())
-        
-        if user_id not in self.user_message_counts:
-            self.user_message_counts[user_id] = {}
-        
-        if timestamp not in self.user_message_counts[user_id]:
-            self.user_message_counts[user_id][timestamp] = 0
-        
-        self.user_message_counts[user_id][timestamp] += 1
-        self.user_last_message[user_id] = now
+        now = time.monotonic()
+        
+        recent = self.user_recent_messages.get(user_id)
+        if recent is None:
+            # Only the last MAX_MESSAGES_PER_10_MINUTES times matter for the check
+            recent = self.user_recent_messages[user_id] = deque(maxlen=Config.MAX_MESSAGES_PER_10_MINUTES)
+        recent.append(now)
+        
+        # Every 10 minutes, forget users with no message inside the window
+        if now - self._rate_limit_swept >= 600:
+            self._rate_limit_swept = now
+            for uid in [uid for uid, times in self.user_recent_messages.items() if times[-1] <= now - 600]:
+                del self.user_recent_messages[uid]
 
 if __name__ == '__main__':
     bot = EnhancedCouncilBot()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Tests for the database schema migrations and the message writer queue
+"""
+
+import os
+import sqlite3
+
+os.environ.setdefault('CHANNEL_ID', '0')
+
+from database import Database
+
+
+def _legacy_database(path):
+    """A database in the pre-unique-index layout, with two duplicated (user, role) pairs"""
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE threads (
+            thread_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            role_id INTEGER NOT NULL,
+            is_active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE messages (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            thread_id INTEGER NOT NULL,
+            telegram_message_id INTEGER NOT NULL,
+            sender_type TEXT NOT NULL,
+            message_text TEXT NOT NULL,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_read BOOLEAN DEFAULT 0
+        );
+        CREATE TABLE message_mappings (
+            telegram_message_id INTEGER PRIMARY KEY,
+            thread_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        INSERT INTO threads (thread_id, user_id, role_id, last_activity) VALUES
+            (1, 10, 1, '2024-01-01 10:00:00'),
+            (2, 10, 1, '2024-03-01 10:00:00'),
+            (3, 10, 1, '2024-02-01 10:00:00'),
+            (4, 20, 1, '2024-01-01 10:00:00'),
+            (5, 20, 1, '2024-01-01 10:00:00'),
+            (6, 10, 2, '2024-01-01 10:00:00');
+        INSERT INTO messages (thread_id, telegram_message_id, sender_type, message_text, is_read) VALUES
+            (1, 100, 'user', 'a', 0),
+            (3, 101, 'admin', 'b', 0),
+            (4, 102, 'admin', 'c', 0),
+            (6, 103, 'user', 'd', 0);
+        INSERT INTO message_mappings (telegram_message_id, thread_id) VALUES (200, 1), (201, 4), (202, 6);
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def test_duplicate_threads_are_merged(tmp_path):
+    path = str(tmp_path / 'bot.db')
+    _legacy_database(path)
+
+    db = Database(path)
+    conn = sqlite3.connect(path)
+
+    # The most recently active thread survives; ties keep the newest thread_id
+    threads = conn.execute('SELECT thread_id, user_id, role_id FROM threads ORDER BY thread_id').fetchall()
+    assert threads == [(2, 10, 1), (5, 20, 1), (6, 10, 2)]
+
+    assert conn.execute('SELECT telegram_message_id, thread_id FROM messages ORDER BY 1').fetchall() == [
+        (100, 2), (101, 2), (102, 5), (103, 6)]
+    assert conn.execute('SELECT telegram_message_id, thread_id FROM message_mappings ORDER BY 1').fetchall() == [
+        (200, 2), (201, 5), (202, 6)]
+
+    # Unread counts follow the user, not the thread
+    assert db.get_unread_messages_count(10) == 1
+    assert db.get_unread_messages_count(20) == 1
+
+    # The unique index is in place and create_thread reuses the surviving thread
+    assert db.create_thread(10, 1) == 2
+    assert db.get_active_thread(20, 1) == 5
+    conn.close()
+
+
+def test_reopening_migrated_database(tmp_path):
+    path = str(tmp_path / 'bot.db')
+    _legacy_database(path)
+    Database(path)
+
+    db = Database(path)
+    assert db.create_thread(30, 1) == db.create_thread(30, 1)
+
+
+def test_queued_writes_are_batched_and_visible_after_flush(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    thread_id = db.create_thread(10, 1)
+    batches = []
+    write_rows = db._write_rows
+    db._write_rows = lambda items: (batches.append(len(items)), write_rows(items))
+
+    for i in range(100):
+        db.add_message(thread_id, 1000 + i, 'user', f'message {i}')
+    db.add_message_mapping(5000, thread_id)
+    db.flush()
+
+    assert [m['telegram_message_id'] for m in db.get_thread_messages(thread_id)] == list(range(1000, 1100))
+    assert db._conn().execute('SELECT thread_id FROM message_mappings WHERE telegram_message_id = 5000').fetchone() == (thread_id,)
+    assert sum(batches) == 101 and max(batches) > 1 and max(batches) <= 64
+
+
+def test_writer_survives_a_failing_batch(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    thread_id = db.create_thread(10, 1)
+
+    # A NOT NULL violation fails its batch; the good rows around it must still land
+    db.add_message(thread_id, 1, 'user', 'before')
+    db.add_message(thread_id, 2, 'user', None)
+    db.add_message(thread_id, 3, 'user', 'after')
+    db.flush()
+    assert [m['message_text'] for m in db.get_thread_messages(thread_id)] == ['before', 'after']
+    assert db.failed_writes == 1
+
+    # A non-sqlite failure (here opening the connection) must not kill the writer thread either
+    conn = db._conn
+    calls = []
+    def failing_conn():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError('boom')
+        return conn()
+    db._conn = failing_conn
+    db.add_message(thread_id, 4, 'user', 'retried')
+    db.flush()
+    db._conn = conn
+
+    db.add_message(thread_id, 5, 'user', 'later')
+    db.flush()
+    assert [m['message_text'] for m in db.get_thread_messages(thread_id)] == ['before', 'after', 'retried', 'later']
+    assert db.failed_writes == 1
+
+
+def test_grouped_writes_commit_or_fail_together(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    thread_id = db.create_thread(10, 1)
+
+    db.add_messages([(thread_id, 1, 'user', 'question'), (thread_id, 2, 'admin', 'forwarded')], [(2, thread_id)])
+    db.add_messages([(thread_id, 3, 'user', 'kept back'), (thread_id, 4, 'admin', None)], [(4, thread_id)])
+    db.flush()
+
+    assert sorted(m['telegram_message_id'] for m in db.get_thread_messages(thread_id)) == [1, 2]
+    assert db._conn().execute('SELECT telegram_message_id FROM message_mappings').fetchall() == [(2,)]
+    assert db.failed_writes == 1
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Tests for the bot's in-memory block lists
+"""
+
+import asyncio
+import os
+from types import SimpleNamespace
+
+os.environ.setdefault('CHANNEL_ID', '0')
+
+from enhanced_bot import EnhancedCouncilBot
+
+
+class FakeDatabase:
+    def __init__(self, blocked):
+        self.blocked = blocked
+        self.calls = []
+    
+    def get_blocked_users(self, admin_user_id):
+        self.calls.append(admin_user_id)
+        return [{'user_id': user_id} for user_id in self.blocked.get(admin_user_id, [])]
+
+
+def _bot(blocked):
+    bot = SimpleNamespace(_blocks={}, db=FakeDatabase(blocked))
+    bot._blocked_set = EnhancedCouncilBot._blocked_set.__get__(bot)
+    bot.is_user_blocked = EnhancedCouncilBot.is_user_blocked.__get__(bot)
+    return bot
+
+
+def test_placeholder_role_id_blocks_nobody():
+    bot = _bot({})
+    assert asyncio.run(bot.is_user_blocked('your_secretary_user_id_here', 42)) is False
+    assert bot.db.calls == []
+
+
+def test_block_list_is_loaded_once():
+    bot = _bot({100: [42]})
+    assert asyncio.run(bot.is_user_blocked('100', 42)) is True
+    assert asyncio.run(bot.is_user_blocked(100, 7)) is False
+    assert bot.db.calls == [100]
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Tests for the keyword search candidate index
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+# Add ai directory to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ai'))
+
+from langchain_rag_system import LangChainRAGSystem
+
+TEXTS = [
+    "The final exam schedule is posted on the board",
+    "Exams will be held in the main hall next week",
+    "Re-examination requests must be filed by Sunday",
+    "A sample text about nothing in particular at all",
+    "سلام به همه دانشجویان عزیز دانشگاه",
+    "والسلام و علیکم، جلسه فردا برگزار میشود",
+    "جلسه شورای صنفی فردا برگزار می‌شود",
+    "کلاس‌های این هفته به صورت مجازی برگزار خواهند شد",
+    "short",
+    "examexamexam without spaces in between",
+    "C++ workshop for new students, room 204",
+]
+
+QUERIES = [
+    "exam", "xam", "Exam schedule", "سلام", "شود", "برگزار میشود", "جلسه فردا",
+    "c++", "room 204", "nothing here matches", "ab", "کلاس", "hall", "xyzzy",
+]
+
+
+@pytest.fixture(scope='module')
+def rag(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('rag')
+    database_file = tmp / 'channels.json'
+    database_file.write_text(json.dumps({
+        "metadata": {"total_channels": 1, "total_messages": len(TEXTS)},
+        "channels": {"test": {"messages": [
+            {"id": i, "text": text, "date": "2024-01-01T00:00:00"} for i, text in enumerate(TEXTS)
+        ]}}
+    }, ensure_ascii=False), encoding='utf-8')
+    os.environ['RAG_CACHE_DIR'] = str(tmp / 'cache')
+    try:
+        return LangChainRAGSystem(database_file=str(database_file), config_file=str(tmp / 'missing.json'))
+    finally:
+        del os.environ['RAG_CACHE_DIR']
+
+
+def _full_scan(rag, query_lower):
+    """Every searchable message the keyword rules match, scanning all lowered texts"""
+    match = rag._keyword_matcher(query_lower)
+    return {i for i, text in enumerate(rag._lowered_texts('test')) if text and match(text)}
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_candidates_keep_every_substring_match(rag, query):
+    query_lower = query.casefold()
+    match = rag._keyword_matcher(query_lower)
+    texts = rag._lowered_texts('test')
+    candidates = rag._keyword_candidates('test', query_lower)
+    found = {i for i in candidates.tolist() if texts[i] and match(texts[i])}
+    assert found == _full_scan(rag, query_lower)
+
+
+def test_substring_examples(rag):
+    assert set(rag._keyword_candidates('test', 'xam').tolist()) >= {0, 1, 2, 9}
+    assert 5 in rag._keyword_candidates('test', 'سلام').tolist()
+    assert 5 in rag._keyword_candidates('test', 'شود').tolist()
+
+
+def test_keyword_index_is_built_per_channel_on_demand(tmp_path, monkeypatch):
+    database_file = tmp_path / 'channels.json'
+    channels = {f"ch{n}": {"messages": [{"id": 1, "text": f"message number {n} about exams"}]} for n in range(5)}
+    database_file.write_text(json.dumps({
+        "metadata": {"total_channels": len(channels), "total_messages": len(channels)},
+        "channels": channels
+    }), encoding='utf-8')
+    monkeypatch.setenv('RAG_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr('langchain_rag_system.MAX_LOADED_CHANNELS', 2)
+    rag = LangChainRAGSystem(database_file=str(database_file), config_file=str(tmp_path / 'missing.json'))
+    
+    # Construction reads no channel shard
+    assert rag.database['channels']._load.cache_info().currsize == 0
+    assert not rag._keyword_index
+    
+    for name in channels:
+        assert rag._keyword_candidates(name, 'exam').tolist() == [0]
+    assert list(rag._keyword_index) == ['ch3', 'ch4']
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Tests for the Telegram export parser's full-load path (used when ijson is not installed)
+"""
+
+import json
+import mmap
+import os
+import sys
+
+import pytest
+
+# Add ai directory to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ai'))
+
+import telegram_export_parser
+from telegram_export_parser import TelegramExportParser, load_json_file
+
+EXPORT = {
+    "name": "Sharif Senfi",
+    "type": "public_channel",
+    "messages": [
+        {"id": 1, "type": "message", "date": "2024-01-01T10:00:00", "from": "Senfi", "views": 7,
+         "text": "  جلسه شورای صنفی فردا برگزار می‌شود  "},
+        {"id": 2, "type": "message", "date": "2024-01-02T10:00:00", "text": "short"},
+        {"id": 3, "type": "service", "date": "2024-01-03T10:00:00", "text": "pinned a message"},
+        {"id": 4, "type": "message", "date": "2024-01-04T10:00:00", "from": "Senfi",
+         "text": [{"type": "bold", "text": "Exam schedule:"}, "\n", {"type": "link", "text": "https://t.me/sharif_senfi/4"}]},
+    ]
+}
+
+
+@pytest.fixture
+def export_file(tmp_path, monkeypatch):
+    # Without ijson, exports are read whole through load_json_file
+    monkeypatch.setattr(telegram_export_parser, 'ijson', None)
+    path = tmp_path / 'result.json'
+    path.write_text(json.dumps(EXPORT, ensure_ascii=False), encoding='utf-8')
+    return str(path)
+
+
+def _check_parsed(channel_data):
+    assert channel_data['name'] == "Sharif Senfi"
+    assert channel_data['messages'] == [
+        {"id": "1", "text": "جلسه شورای صنفی فردا برگزار می‌شود", "date": "2024-01-01T10:00:00",
+         "from": "Senfi", "views": 7, "type": "message"},
+        {"id": "4", "text": "Exam schedule: https://t.me/sharif_senfi/4", "date": "2024-01-04T10:00:00",
+         "from": "Senfi", "views": 0, "type": "message"},
+    ]
+
+
+def test_full_load_through_mmap_with_orjson(export_file, monkeypatch):
+    pytest.importorskip('orjson')
+    mapped = []
+    real_mmap = mmap.mmap
+    def spy_mmap(*args, **kwargs):
+        mapped.append(args)
+        return real_mmap(*args, **kwargs)
+    monkeypatch.setattr(telegram_export_parser.mmap, 'mmap', spy_mmap)
+
+    assert load_json_file(export_file) == EXPORT
+    _check_parsed(TelegramExportParser().parse_json_file('senfi', export_file))
+    assert len(mapped) == 2
+
+
+def test_full_load_with_stdlib_json(export_file, monkeypatch):
+    monkeypatch.setattr(telegram_export_parser, 'orjson', None)
+
+    assert load_json_file(export_file) == EXPORT
+    _check_parsed(TelegramExportParser().parse_json_file('senfi', export_file))